@@ -18,6 +18,10 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 import os
 import logging
+import time
+
+# the startup is timed from here, see tools/startup_time.py
+_START_TIME = time.time()
 
 from pprint import pformat
 
@@ -28,7 +32,6 @@ gi.require_version('Gtk', '3.0')
 from gi.repository import GLib
 from gi.repository import GObject
 from gi.repository import Gdk
-from gi.repository import GdkPixbuf
 from gi.repository import Pango
 from gi.repository import Gtk
 
@@ -59,12 +62,20 @@ except ImportError:
 import dbus
 import configparser
 import base64
-import urllib.request, urllib.error, urllib.parse
+import urllib.error
 import socket
 
 
 from listview import ListView
 import opds
+import covercache
+import coverimages
+import downloadmanager
+import feedcache
+import iamanifests
+import partialdownloads
+import querycache
+import workers
 import languagenames
 import devicemanager
 
@@ -79,6 +90,23 @@ READ_STREAM_SERVICE = 'read-activity-http'
 # named after our pid, to inhibit suspend.
 POWERD_INHIBIT_DIR = '/var/run/powerd-inhibit-suspend'
 
+# covers of the rows below the visible ones that are prefetched too
+_PREFETCH_LOOKAHEAD = 10
+# ms to wait for the scrolling to stop before prefetching
+_PREFETCH_DELAY = 300
+# Internet Archive file lists fetched around the selected book
+_MANIFEST_NEIGHBOURS = 3
+# ms without typing before the search starts
+_SEARCH_DELAY = 500
+# seconds the cover cache index waits for more covers before it is written
+_COVER_CACHE_SAVE_DELAY = 5
+
+
+def _format_size(size):
+    if size < 1024 * 1024:
+        return _('%d KB') % max(1, size // 1024)
+    return _('%.1f MB') % (size / (1024.0 * 1024))
+
 
 class GetIABooksActivity(activity.Activity):
 
@@ -90,17 +118,37 @@ class GetIABooksActivity(activity.Activity):
         self._sequence = 0
         self.selected_book = None
         self.queryresults = None
-        self._getter = None
+        # (source, query, language) of self.queryresults
+        self._query_key = None
+        self._query_cache = querycache.QueryCache()
+        self._search_timeout_id = None
         self.show_images = True
+        self.cover_cache_size = 20
+        self.max_downloads = 2
+        self.downloads_per_host = 2
+        self.download_segments = 3
         self.languages = {}
-        self._lang_code_handler = languagenames.LanguageNames()
+        self._lang_code_handler = languagenames.LanguageNames(
+                os.path.join(self.get_activity_root(), 'data',
+                             'language_names.json'))
+        opds.set_language_names(self._lang_code_handler)
         self.catalogs_configuration = {}
         self.catalog_history = []
 
+        opds.set_feed_cache(feedcache.FeedCache(
+                os.path.join(self.get_activity_root(), 'data', 'feeds')))
+        opds.set_partial_store(partialdownloads.PartialStore(
+                os.path.join(self.get_activity_root(), 'data', 'partial')))
+        opds.set_manifest_cache(iamanifests.ManifestCache(
+                os.path.join(self.get_activity_root(), 'data', 'manifests')))
+
         if os.path.exists('/etc/get-books.cfg'):
             self._read_configuration('/etc/get-books.cfg')
         else:
             self._read_configuration()
+        self._cover_cache = covercache.CoverCache(
+                os.path.join(self.get_activity_root(), 'data', 'covers'),
+                self.cover_cache_size * 1024 * 1024)
 
         toolbar_box = ToolbarBox()
         activity_button = ToolButton()
@@ -124,11 +172,48 @@ class GetIABooksActivity(activity.Activity):
         toolbar_box.show_all()
         self._books_toolbar = toolbar_box.toolbar
 
+        panel_height = int(Gdk.Screen.height() / 4)
+        self._cover_renderer = coverimages.CoverRenderer(
+                (panel_height // 3 * 2, panel_height),
+                style.COLOR_PANEL_GREY.get_int(),
+                (style.zoom(300), style.zoom(225)),
+                style.COLOR_WHITE.get_int())
+        self._cover_key = None
+        self._cover_images = None
+
+        self._download_manager = downloadmanager.DownloadManager(
+                self.max_downloads, self.downloads_per_host,
+                self.download_segments)
+        self._download_manager.connect('item-added',
+                self.__download_added_cb)
+        self._download_manager.connect('item-progress',
+                self.__download_progress_cb)
+        self._download_manager.connect('item-finished',
+                self.__download_finished_cb)
+
         self._create_controls()
+        self._first_draw_id = self.connect('draw', self.__first_draw_cb)
 
         self.using_powerd = os.access(POWERD_INHIBIT_DIR, os.W_OK)
 
-        self.__book_downloader = self.__image_downloader = None
+        self.__image_downloader = None
+        self._prefetch_requests = {}
+        # ManifestFetch of the file lists of the books around the selected
+        # one
+        self._manifest_fetches = []
+        self._prefetch_timeout_id = None
+        self._cover_cache_save_id = None
+        logging.debug('Activity built %d ms after the import',
+                      (time.time() - _START_TIME) * 1000)
+
+    def __first_draw_cb(self, widget, context):
+        self.disconnect(self._first_draw_id)
+        logging.debug('First paint %d ms after the import',
+                      (time.time() - _START_TIME) * 1000)
+        # the cover cache sweeps its directory, do it off the main loop
+        opds.get_worker_pool().submit(workers.QUEUE_PREFETCH,
+                                      covercache.LoadTask(self._cover_cache))
+        return False
 
     def get_path(self):
         self._sequence += 1
@@ -161,14 +246,47 @@ class GetIABooksActivity(activity.Activity):
         config.readfp(open(file_name))
         if config.has_option('GetBooks', 'show_images'):
             self.show_images = config.getboolean('GetBooks', 'show_images')
+        if config.has_option('GetBooks', 'max_downloads'):
+            self.max_downloads = config.getint('GetBooks', 'max_downloads')
+        if config.has_option('GetBooks', 'downloads_per_host'):
+            self.downloads_per_host = config.getint('GetBooks',
+                                                    'downloads_per_host')
+        if config.has_option('GetBooks', 'download_segments'):
+            self.download_segments = config.getint('GetBooks',
+                                                   'download_segments')
+        if config.has_option('GetBooks', 'cover_cache_size'):
+            self.cover_cache_size = config.getint('GetBooks',
+                                                  'cover_cache_size')
+        if config.has_option('GetBooks', 'connections_per_host'):
+            opds.set_connections_per_host(
+                config.getint('GetBooks', 'connections_per_host'))
+        if config.has_option('GetBooks', 'requests_per_host'):
+            opds.set_requests_per_host(
+                config.getint('GetBooks', 'requests_per_host'))
+        if config.has_option('GetBooks', 'result_pages'):
+            opds.set_max_pages(config.getint('GetBooks', 'result_pages'))
+        pool_workers = dict(workers.DEFAULT_WORKERS)
+        for queue_name in pool_workers:
+            option = '%s_workers' % queue_name
+            if config.has_option('GetBooks', option):
+                pool_workers[queue_name] = config.getint('GetBooks', option)
+        opds.set_worker_pool(workers.WorkerPool(pool_workers))
         self.languages = {}
         if config.has_option('GetBooks', 'languages'):
             languages_param = config.get('GetBooks', 'languages')
             for language in languages_param.split(','):
                 lang_code = language.strip()
                 if len(lang_code) > 0:
-                    self.languages[lang_code] = \
-                    self._lang_code_handler.get_full_language_name(lang_code)
+                    self.languages[lang_code] = lang_code
+        # parsing the language names is slow, the codes are shown until
+        # it is done
+        if self._lang_code_handler.load_cached():
+            self._set_language_names()
+        else:
+            opds.get_worker_pool().submit(workers.QUEUE_PREFETCH,
+                    languagenames.LoadTask(self._lang_code_handler,
+                            lambda: GLib.idle_add(
+                                    self.__language_names_loaded_cb)))
 
         for section in config.sections():
             if section != 'GetBooks' and not section.startswith('Catalogs'):
@@ -237,6 +355,8 @@ class GetIABooksActivity(activity.Activity):
         toolbar.search_entry.add_clear_button()
         toolbar.search_entry.connect('activate',
                 self.__search_entry_activate_cb)
+        toolbar.search_changed_cb_id = toolbar.search_entry.connect(
+                'changed', self.__search_entry_changed_cb)
         width = int(Gdk.Screen.width() / 4)
         toolbar.search_entry.set_size_request(width, -1)
         book_search_item.add(toolbar.search_entry)
@@ -283,6 +403,8 @@ class GetIABooksActivity(activity.Activity):
         self._refresh_sources(toolbar)
         self._device_manager.connect('device-changed',
                 self.__device_changed_cb)
+        self._device_manager.connect('device-removed',
+                self.__device_removed_cb)
 
         toolbar.search_entry.grab_focus()
         return toolbar
@@ -304,16 +426,21 @@ class GetIABooksActivity(activity.Activity):
         self.listview.handler_block(self.selection_cb_id)
         self.listview.clear()
         self.listview.handler_unblock(self.selection_cb_id)
+        self._cancel_cover_prefetch()
+        self._cancel_manifest_prefetch()
         logging.debug('SOURCE %s', catalog_config['source'])
+        self._cancel_search()
+        self._books_toolbar.search_entry.handler_block(
+                self._books_toolbar.search_changed_cb_id)
         self._books_toolbar.search_entry.props.text = ''
+        self._books_toolbar.search_entry.handler_unblock(
+                self._books_toolbar.search_changed_cb_id)
         self.source = catalog_config['source']
         self.ignore_mimetypes = catalog_config['ignore_mimetypes']
         position = _SOURCES_CONFIG[self.source]['position']
         self._books_toolbar.source_combo.set_active(position)
 
-        if self.queryresults is not None:
-            self.queryresults.cancel()
-            self.queryresults = None
+        self._drop_query()
 
         self.queryresults = opds.RemoteQueryResult(catalog_config,
                 '', query_language)
@@ -323,26 +450,47 @@ class GetIABooksActivity(activity.Activity):
         # every time that we want to change it
         self.get_window().set_cursor(Gdk.Cursor(Gdk.CursorType.WATCH))
 
+        self.queryresults.connect('entries-added',
+                self.__query_entries_added_cb)
+        self.queryresults.connect('books-replaced',
+                self.__query_books_replaced_cb)
         self.queryresults.connect('updated', self.__query_updated_cb)
 
-    def update_format_combo(self, links):
+    def update_format_combo(self, links, files=None, active_type=None):
         self.format_combo.handler_block(self.__format_changed_cb_id)
         self.format_combo.remove_all()
+        position = 0
+        active = 0
         for key in list(_MIMETYPES.keys()):
             if _MIMETYPES[key] in list(links.keys()) and \
                     not _MIMETYPES[key] in self.ignore_mimetypes:
-                self.format_combo.append_item(_MIMETYPES[key], key)
-        self.format_combo.set_active(0)
+                label = key
+                if files is not None and \
+                        files[_MIMETYPES[key]][1] is not None:
+                    label = '%s (%s)' % (key, _format_size(
+                            files[_MIMETYPES[key]][1]))
+                self.format_combo.append_item(_MIMETYPES[key], label)
+                if _MIMETYPES[key] == active_type:
+                    active = position
+                position += 1
+        self.format_combo.set_active(active)
         self.format_combo.handler_unblock(self.__format_changed_cb_id)
 
     def get_search_terms(self):
         return self._books_toolbar.search_entry.props.text
 
+    def __device_removed_cb(self, mgr, mount_path):
+        # the memory map of the catalog index dies with the volume
+        opds.drop_volume_index(mount_path)
+
     def __device_changed_cb(self, mgr):
         logging.debug('Device was added/removed')
         self._refresh_sources(self._books_toolbar)
 
     def _refresh_sources(self, toolbar):
+        # a volume plugged or found later keeps the source the user chose
+        active_source = toolbar.source_combo.props.value
+        active = None
         toolbar.source_combo.handler_block(toolbar.source_changed_cb_id)
 
         #TODO: Do not blindly clear this
@@ -353,13 +501,19 @@ class GetIABooksActivity(activity.Activity):
             toolbar.source_combo.append_item(_SOURCES[key], key,
                 icon_name='internet-icon')
             _SOURCES_CONFIG[key]['position'] = position
+            if _SOURCES[key] == active_source:
+                active = position
             position = position + 1
 
         # Add menu for local books
         if len(_SOURCES) > 0:
             toolbar.source_combo.append_separator()
+            position = position + 1
         toolbar.source_combo.append_item('local_books', _('My books'),
                 icon_name='activity-journal')
+        if active_source == 'local_books':
+            active = position
+        position = position + 1
 
         devices = self._device_manager.get_devices()
 
@@ -376,11 +530,22 @@ class GetIABooksActivity(activity.Activity):
                 logging.debug('Adding device %s', (label))
                 if first_device:
                     toolbar.source_combo.append_separator()
+                    position = position + 1
                     first_device = False
                 toolbar.source_combo.append_item(mount_point, label)
-
-        toolbar.source_combo.set_active(0)
-        toolbar.source_combo.handler_unblock(toolbar.source_changed_cb_id)
+                if mount_point == active_source:
+                    active = position
+                position = position + 1
+                if device['have_catalog']:
+                    opds.prepare_volume_index(mount_point)
+
+        if active is not None or active_source is None:
+            toolbar.source_combo.set_active(active or 0)
+            toolbar.source_combo.handler_unblock(toolbar.source_changed_cb_id)
+        else:
+            # the volume shown was removed, show the first source instead
+            toolbar.source_combo.handler_unblock(toolbar.source_changed_cb_id)
+            toolbar.source_combo.set_active(0)
 
     def __format_changed_cb(self, combo):
         self.show_book_data(False)
@@ -389,8 +554,28 @@ class GetIABooksActivity(activity.Activity):
         self.find_books(self.get_search_terms())
 
     def __search_entry_activate_cb(self, entry):
+        self._cancel_search()
         self.find_books(self.get_search_terms())
 
+    def __search_entry_changed_cb(self, entry):
+        # search as the user types, once the typing stops
+        self._cancel_search()
+        self._search_timeout_id = GLib.timeout_add(_SEARCH_DELAY,
+                self.__search_timeout_cb)
+
+    def __search_timeout_cb(self):
+        self._search_timeout_id = None
+        search_text = self.get_search_terms()
+        if self._books_toolbar.source_combo.props.value == 'local_books' or \
+                len(search_text) >= 3:
+            self.find_books(search_text)
+        return False
+
+    def _cancel_search(self):
+        if self._search_timeout_id is not None:
+            GLib.source_remove(self._search_timeout_id)
+            self._search_timeout_id = None
+
     def __get_book_cb(self, button):
         self.get_book()
 
@@ -511,7 +696,7 @@ class GetIABooksActivity(activity.Activity):
                 fill=False, padding=0)
 
         # books listview
-        self.listview = ListView(self._lang_code_handler)
+        self.listview = ListView()
         self.selection_cb_id = self.listview.connect('selection-changed',
                                                      self.selection_cb)
         self.listview.set_enable_search(False)
@@ -578,6 +763,21 @@ class GetIABooksActivity(activity.Activity):
                 fill=False, padding=0)
         vbox_download.pack_start(self.progressbox, False, False, 10)
 
+        # title, percent, item
+        self._downloads_store = Gtk.ListStore(str, int, object)
+        self._downloads_view = Gtk.TreeView(model=self._downloads_store)
+        self._downloads_view.props.headers_visible = False
+        self._downloads_view.append_column(Gtk.TreeViewColumn('',
+                Gtk.CellRendererProgress(), value=1, text=0))
+        self._downloads_scroller = Gtk.ScrolledWindow()
+        self._downloads_scroller.set_policy(Gtk.PolicyType.NEVER,
+                Gtk.PolicyType.AUTOMATIC)
+        self._downloads_scroller.set_size_request(-1, style.zoom(120))
+        self._downloads_scroller.add(self._downloads_view)
+        self._downloads_scroller.set_no_show_all(True)
+        self._downloads_view.show()
+        vbox_download.pack_start(self._downloads_scroller, True, True, 0)
+
         bottom_hbox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
 
         if self.show_images:
@@ -641,10 +841,21 @@ class GetIABooksActivity(activity.Activity):
         if self.queryresults is not None:
             self.queryresults.cancel()
             self.queryresults = None
+        self._cancel_cover_prefetch()
+        self._cancel_manifest_prefetch()
+        # the books being downloaded record where to resume
+        self._download_manager.cancel_all()
+        if self._cover_cache_save_id is not None:
+            GLib.source_remove(self._cover_cache_save_id)
+            self._cover_cache_save_id = None
+        self._cover_cache.save()
         return True
 
     def selection_cb(self, widget):
         selected_book = self.listview.get_selected_book()
+        if selected_book is not None and selected_book.is_stub():
+            # shown again once its page is downloaded
+            return
         if self.source == 'local_books':
             if selected_book:
                 self.selected_book = selected_book
@@ -656,10 +867,41 @@ class GetIABooksActivity(activity.Activity):
         else:
             self.clear_downloaded_bytes()
             if selected_book:
-                self.update_format_combo(selected_book.get_types())
                 self.selected_book = selected_book
+                self.update_format_combo(selected_book.get_types(),
+                                         self._get_book_files(selected_book))
                 self._download.show()
                 self.show_book_data()
+                self._fetch_book_files()
+
+    def _get_book_files(self, book):
+        if isinstance(book, opds.InternetArchiveBook):
+            return book.get_files()
+        return None
+
+    def _fetch_book_files(self):
+        # the books around the selected one are likely to be selected next
+        self._cancel_manifest_prefetch()
+        row = self.listview.getFirstSelectedRowIndex()
+        for n in range(max(0, row - _MANIFEST_NEIGHBOURS),
+                min(self.listview.getCount(), row + _MANIFEST_NEIGHBOURS + 1)):
+            book = self.listview.getItem(n, ListView.ROW_BOOK)
+            if isinstance(book, opds.InternetArchiveBook) and \
+                    book.get_files() is None:
+                self._manifest_fetches.append(
+                        book.fetch_files(self.__book_files_cb))
+
+    def _cancel_manifest_prefetch(self):
+        # a Get Book waiting for the same list still gets it
+        for fetch in self._manifest_fetches:
+            fetch.cancel()
+        self._manifest_fetches = []
+
+    def __book_files_cb(self, book, files):
+        if files is not None and book is self.selected_book:
+            # the format the user picked meanwhile is kept
+            self.update_format_combo(book.get_types(), files,
+                                     self.format_combo.props.value)
 
     def show_message(self, text):
         self.msg_label.set_text(text)
@@ -679,12 +921,9 @@ class GetIABooksActivity(activity.Activity):
             book_data += _('Summary:\t') + self.selected_summary + '\n'
         self.selected_language_code = self.selected_book.get_language()
         if self.selected_language_code != '':
-            try:
-                self.selected_language = \
-                    self._lang_code_handler.get_full_language_name(
-                        self.selected_book.get_language())
-            except:
-                self.selected_language = self.selected_book.get_language()
+            self.selected_language = \
+                    self.selected_book.get_language_name() or \
+                    self.selected_language_code
             book_data += _('Language:\t') + self.selected_language + '\n'
         book_data += _('Publisher:\t') + self.selected_publisher + '\n'
         textbuffer = self.textview.get_buffer()
@@ -698,8 +937,8 @@ class GetIABooksActivity(activity.Activity):
                 cover_image_buffer = self.get_journal_entry_cover_image(
                         self.selected_book.get_object_id())
                 if (cover_image_buffer):
-                    self.add_image_buffer(
-                        self.get_pixbuf_from_buffer(cover_image_buffer))
+                    self._show_cover(self.selected_book.get_object_id(),
+                                     data=cover_image_buffer)
                 else:
                     self.add_default_image()
             else:
@@ -708,14 +947,6 @@ class GetIABooksActivity(activity.Activity):
                 if url_image:
                     self.download_image(list(url_image.values())[0])
 
-    def get_pixbuf_from_buffer(self, image_buffer):
-        """Buffer To Pixbuf"""
-        pixbuf_loader = GdkPixbuf.PixbufLoader()
-        pixbuf_loader.write(image_buffer)
-        pixbuf_loader.close()
-        pixbuf = pixbuf_loader.get_pixbuf()
-        return pixbuf
-
     def get_journal_entry_cover_image(self, object_id):
         ds_object = datastore.get(object_id)
         if 'cover_image' in ds_object.metadata:
@@ -727,26 +958,117 @@ class GetIABooksActivity(activity.Activity):
             return ""
 
     def download_image(self,  url):
-        self._inhibit_suspend()
-        self.progress_show()
+        if url in self._prefetch_requests:
+            # download it with the priority of the selected book
+            self._prefetch_requests.pop(url).cancel()
         if self.__image_downloader is not None:
             self.__image_downloader.stop()
-        self.__image_downloader = opds.FileDownloader(url, self.get_path())
-        self.__image_downloader.connect('updated', self.__image_updated_cb)
+            self.__image_downloader = None
+            if not self._is_downloading_books():
+                self.progress_hide()
+                self._allow_suspend()
+        cached_path = self._cover_cache.get(url)
+        if cached_path is not None:
+            self._show_cover(url, path=cached_path, downloaded=True)
+            return
+        self._inhibit_suspend()
+        self.progress_show()
+        self.__image_downloader = opds.FileDownloader(url, self.get_path(),
+                                                      workers.QUEUE_COVERS)
+        self.__image_downloader.connect('updated', self.__image_updated_cb,
+                                        url)
         self.__image_downloader.connect('progress', self.__image_progress_cb)
 
-    def __image_updated_cb(self, downloader, path, content_type):
+    def __image_updated_cb(self, downloader, path, content_type, url):
         if path is not None:
-            self.add_image(path)
-            self.exist_cover_image = True
-            os.remove(path)
+            self._show_cover(url, path=self._cover_cache.store(url, path),
+                             downloaded=True)
+            self._schedule_cover_cache_save()
         else:
             self.add_default_image()
         self.__image_downloader = None
-        GLib.timeout_add(500, self.progress_hide)
-        self._allow_suspend()
+        # the progress bar shows the books downloads if there are some
+        if not self._is_downloading_books():
+            GLib.timeout_add(500, self.progress_hide)
+            self._allow_suspend()
+
+    def _is_downloading_books(self):
+        return len(self._download_manager.get_items()) > 0
+
+    def _schedule_cover_prefetch(self):
+        if not self.show_images or self.source == 'local_books':
+            return
+        if self._prefetch_timeout_id is None:
+            self._prefetch_timeout_id = GLib.timeout_add(
+                    _PREFETCH_DELAY, self.__prefetch_covers_cb)
+
+    def _cancel_cover_prefetch(self):
+        if self._prefetch_timeout_id is not None:
+            GLib.source_remove(self._prefetch_timeout_id)
+            self._prefetch_timeout_id = None
+        for request in self._prefetch_requests.values():
+            request.cancel()
+        self._prefetch_requests = {}
+
+    def _get_visible_rows(self):
+        visible_range = self.listview.get_visible_range()
+        if not visible_range or visible_range[0] is None:
+            return []
+        start, end = visible_range[-2:]
+        last = min(end.get_indices()[0] + _PREFETCH_LOOKAHEAD,
+                   self.listview.getCount() - 1)
+        return list(range(start.get_indices()[0], last + 1))
+
+    def __prefetch_covers_cb(self):
+        self._prefetch_timeout_id = None
+        urls = []
+        for row in self._get_visible_rows():
+            book = self.listview.getItem(row, ListView.ROW_BOOK)
+            if book.is_stub():
+                continue
+            url_image = book.get_image_url()
+            if not url_image:
+                continue
+            url = list(url_image.values())[0]
+            if url.startswith('http') and url not in urls and \
+                    self._cover_cache.get(url) is None:
+                urls.append(url)
+
+        # the rows scrolled out of view are not worth the bandwidth
+        for url in list(self._prefetch_requests.keys()):
+            if url not in urls:
+                self._prefetch_requests.pop(url).cancel()
+        # all of them at once, the network engine does not need a thread
+        # for each
+        for url in urls:
+            if url in self._prefetch_requests:
+                continue
+            self._prefetch_requests[url] = opds.get_net_engine().fetch(url,
+                    self.__prefetch_ready_cb, path=self.get_path(),
+                    user_data=url)
+        return False
+
+    def __prefetch_ready_cb(self, response, error, url):
+        self._prefetch_requests.pop(url, None)
+        if response is not None:
+            self._cover_cache.store(url, response.path)
+            self._schedule_cover_cache_save()
+
+    def _schedule_cover_cache_save(self):
+        # one write for all the covers stored meanwhile
+        if self._cover_cache_save_id is None:
+            self._cover_cache_save_id = GLib.timeout_add_seconds(
+                    _COVER_CACHE_SAVE_DELAY, self.__save_cover_cache_cb)
+
+    def __save_cover_cache_cb(self):
+        self._cover_cache_save_id = None
+        opds.get_worker_pool().submit(workers.QUEUE_PREFETCH,
+                                      covercache.SaveTask(self._cover_cache))
+        return False
 
     def __image_progress_cb(self, downloader, progress):
+        if self._is_downloading_books():
+            return
         self.progressbar.set_fraction(progress)
         while Gtk.events_pending():
             Gtk.main_iteration()
@@ -754,37 +1076,54 @@ class GetIABooksActivity(activity.Activity):
     def add_default_image(self):
         file_path = os.path.join(activity.get_bundle_path(),
                 'generic_cover.png')
-        self.add_image(file_path)
-
-    def add_image(self, file_path):
-        pixbuf = GdkPixbuf.Pixbuf.new_from_file(file_path)
-        self.add_image_buffer(pixbuf)
-
-    def add_image_buffer(self, pixbuf):
-        image_height = int(Gdk.Screen.height() / 4)
-        image_width = image_height / 3 * 2
-        width, height = pixbuf.get_width(), pixbuf.get_height()
-        scale = 1
-        if (width > image_width) or (height > image_height):
-            scale_x = image_width / float(width)
-            scale_y = image_height / float(height)
-            scale = min(scale_x, scale_y)
-
-        pixbuf2 = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB,
-                pixbuf.get_has_alpha(), pixbuf.get_bits_per_sample(),
-                image_width, image_height)
-
-        pixbuf2.fill(style.COLOR_PANEL_GREY.get_int())
+        self._show_cover(file_path, path=file_path)
+
+    def _show_cover(self, key, path=None, data=None, downloaded=False):
+        # the images are made on a worker, the last cover asked for is
+        # shown when they are ready
+        self._cover_key = key
+        images = self._cover_renderer.get(key)
+        if images is not None:
+            self.__cover_ready_cb(key, images, downloaded)
+        else:
+            self._cover_renderer.render(key, self.__cover_ready_cb,
+                                        path=path, data=data,
+                                        user_data=downloaded)
 
-        margin_x = int((image_width - (width * scale)) / 2)
-        margin_y = int((image_height - (height * scale)) / 2)
+    def __cover_ready_cb(self, key, images, downloaded):
+        if key != self._cover_key:
+            return
+        if images is None:
+            if downloaded:
+                self.add_default_image()
+            return
+        self._cover_images = images
+        self.image.set_from_pixbuf(images.pixbuf)
+        self.exist_cover_image = downloaded
 
-        pixbuf.scale(pixbuf2, margin_x, margin_y,
-                image_width - (margin_x * 2), image_height - (margin_y * 2),
-                margin_x, margin_y, scale, scale,
-                GdkPixbuf.InterpType.BILINEAR)
+    def _set_language_names(self):
+        for lang_code in self.languages:
+            try:
+                self.languages[lang_code] = \
+                    self._lang_code_handler.get_full_language_name(lang_code)
+            except KeyError:
+                pass
 
-        self.image.set_from_pixbuf(pixbuf2)
+    def __language_names_loaded_cb(self):
+        self._set_language_names()
+        if len(self.languages) > 0:
+            toolbar = self._books_toolbar
+            toolbar.language_combo.handler_block(
+                    toolbar.language_changed_cb_id)
+            active = toolbar.language_combo.get_active()
+            toolbar.language_combo.remove_all()
+            toolbar.language_combo.append_item('all', _('Any language'))
+            for key in list(self.languages.keys()):
+                toolbar.language_combo.append_item(key, self.languages[key])
+            toolbar.language_combo.set_active(active)
+            toolbar.language_combo.handler_unblock(
+                    toolbar.language_changed_cb_id)
+        return False
 
     def get_query_language(self):
         query_language = None
@@ -792,10 +1131,25 @@ class GetIABooksActivity(activity.Activity):
             query_language = self._books_toolbar.language_combo.props.value
         return query_language
 
+    def _drop_query(self):
+        # finished queries stay in the query cache with the pages they
+        # have, the downloads of any query are stopped
+        if self.queryresults is not None:
+            self.queryresults.stop_pending()
+            if not self.queryresults.is_ready():
+                self.queryresults.cancel()
+        self.queryresults = None
+        self._query_key = None
+
     def find_books(self, search_text=''):
-        self._inhibit_suspend()
         self.source = self._books_toolbar.source_combo.props.value
         query_language = self.get_query_language()
+        query_key = (self.source, search_text, query_language)
+        if self.queryresults is not None and query_key == self._query_key:
+            # the same search is already shown or on its way, a failed
+            # search has no key
+            return
+        self._inhibit_suspend()
 
         self.enable_button(False)
         self.clear_downloaded_bytes()
@@ -803,10 +1157,11 @@ class GetIABooksActivity(activity.Activity):
         self.listview.handler_block(self.selection_cb_id)
         self.listview.clear()
         self.listview.handler_unblock(self.selection_cb_id)
+        self._cancel_cover_prefetch()
+        self._cancel_manifest_prefetch()
 
-        if self.queryresults is not None:
-            self.queryresults.cancel()
-            self.queryresults = None
+        self._drop_query()
+        logging.debug('Workers %s', opds.get_worker_pool().get_stats())
 
         if self.source == 'local_books':
             self.listview.populate_with_books(
@@ -818,10 +1173,18 @@ class GetIABooksActivity(activity.Activity):
                 self.show_message(_('You must enter at least 3 letters.'))
                 self._books_toolbar.search_entry.grab_focus()
                 return
+            self._query_key = query_key
+            cached = self._query_cache.get(query_key)
+            if cached is not None:
+                logging.debug('Search of %s found in the cache', search_text)
+                self.queryresults = cached
+                self.listview.populate_with_books(cached.get_book_list())
+                self.__query_updated_cb(cached, False)
+                self._schedule_cover_prefetch()
+                return
             if self.source == 'Internet Archive':
                 self.queryresults = \
-                        opds.InternetArchiveQueryResult(search_text,
-                                                        self.get_path(), self)
+                        opds.InternetArchiveQueryResult(search_text)
             elif self.source in _SOURCES_CONFIG:
                 repo_configuration = _SOURCES_CONFIG[self.source]
                 self.queryresults = opds.RemoteQueryResult(repo_configuration,
@@ -832,18 +1195,48 @@ class GetIABooksActivity(activity.Activity):
 
             self.show_message(_('Performing lookup, please wait...'))
             self.get_window().set_cursor(Gdk.Cursor(Gdk.CursorType.WATCH))
+            self.queryresults.connect('entries-added',
+                    self.__query_entries_added_cb)
+            self.queryresults.connect('books-replaced',
+                    self.__query_books_replaced_cb)
             self.queryresults.connect('updated', self.__query_updated_cb)
 
     def show_alert_cb(self, message):
         self.show_message(message)
         self.get_window().set_cursor(None)
 
+    def __query_entries_added_cb(self, query, books):
+        # books are shown while the rest of the feed is still downloading
+        if query is not self.queryresults:
+            return
+        self.listview.populate_with_books(books)
+        self.hide_message()
+        self._schedule_cover_prefetch()
+
+    def __query_books_replaced_cb(self, query, replaced):
+        # pages of the result dropped from memory, or downloaded again
+        if query is not self.queryresults:
+            return
+        self.listview.replace_books(replaced)
+        selected_book = self.listview.get_selected_book()
+        if selected_book is not None and \
+                selected_book in [new for old, new in replaced]:
+            self.selection_cb(self.listview)
+        self._schedule_cover_prefetch()
+
     def __query_updated_cb(self, query, midway):
-        self.listview.populate(self.queryresults)
-        if hasattr(self.queryresults, '_feedobj') and \
-           'bozo_exception' in self.queryresults._feedobj:
+        if query is not self.queryresults:
+            return
+        # the network results are kept, a volume is searched again
+        if self._query_key is not None and query.is_ready() and \
+                not query.is_local() and query.get_error() is None and \
+                not query.get_catalog_list():
+            self._query_cache.store(self._query_key, query)
+        bozo_exception = query.get_error()
+        if bozo_exception is not None:
             # something went wrong and we have to inform about this
-            bozo_exception = self.queryresults._feedobj.bozo_exception
+            # searching again retries instead of keeping the error
+            self._query_key = None
             if isinstance(bozo_exception, urllib.error.URLError):
                 if isinstance(bozo_exception.reason, socket.gaierror):
                     if bozo_exception.reason.errno == -2:
@@ -867,7 +1260,8 @@ class GetIABooksActivity(activity.Activity):
                 # the requested language
                 only_english = True
                 for book in self.queryresults.get_book_list():
-                    if book.get_language() == query_language:
+                    if not book.is_stub() and \
+                            book.get_language() == query_language:
                         only_english = False
                         break
                 if only_english:
@@ -942,6 +1336,11 @@ class GetIABooksActivity(activity.Activity):
             self.bt_catalogs.hide()
 
     def __vadjustment_value_changed_cb(self, vadjustment):
+        self._schedule_cover_prefetch()
+        if self.queryresults is not None and self.source != 'local_books':
+            self.queryresults.set_visible_books(
+                    [self.listview.getItem(row, ListView.ROW_BOOK)
+                     for row in self._get_visible_rows()])
 
         if not self.queryresults.is_ready():
             return
@@ -962,117 +1361,162 @@ class GetIABooksActivity(activity.Activity):
         if self.__image_downloader is not None:
             self.__image_downloader.stop()
 
-        if self.__book_downloader is not None:
-            self.__book_downloader.stop()
+        # a download selected in the list is cancelled alone
+        model, tree_iter = self._downloads_view.get_selection().get_selected()
+        if tree_iter is not None:
+            self._download_manager.cancel(model.get_value(tree_iter, 2))
+        else:
+            self._download_manager.cancel_all()
 
-        self.progress_hide()
+        if not self._is_downloading_books():
+            self.progress_hide()
+            self._allow_suspend()
         self.enable_button(True)
-        self.listview.props.sensitive = True
-        self._books_toolbar.search_entry.set_sensitive(True)
-        self._allow_suspend()
 
     def get_book(self):
         self.enable_button(False)
         self.clear_downloaded_bytes()
         self.progress_show()
         if self.source != 'local_books':
+            # the user can select other books while this one downloads
+            book_info = self._get_book_info()
             self.selected_book.get_download_links(self.format_combo.props.value,
-                                                  self.download_book,
-                                                  self.get_path())
+                    lambda url: self.download_book(url, book_info),
+                    lambda files: self.__download_links_error_cb(files,
+                                                                 book_info))
 
-    def download_book(self,  url):
+    def __download_links_error_cb(self, files, book_info):
+        self.progress_hide()
+        self.enable_button(True)
+        if files is None:
+            self._show_error_alert(_('Error: Could not download %s. ' +
+                    'The list of its files could not be read.') %
+                    book_info['title'])
+        else:
+            self._show_error_alert(_('Error: Could not download %s. ' +
+                    'It is not available in this format.') %
+                    book_info['title'])
+
+    def download_book(self, url, book_info):
         logging.debug('DOWNLOAD BOOK %s', url)
         self._inhibit_suspend()
-        self.listview.props.sensitive = False
-        self._books_toolbar.search_entry.set_sensitive(False)
-        self.__book_downloader = opds.FileDownloader(url, self.get_path())
-        self.__book_downloader.connect('updated', self.__book_updated_cb)
-        self.__book_downloader.connect('progress', self.__book_progress_cb)
-
-    def __book_updated_cb(self, downloader, path, content_type):
-        self._books_toolbar.search_entry.set_sensitive(True)
-        self.listview.props.sensitive = True
-        self._allow_suspend()
-        GLib.timeout_add(500, self.progress_hide)
+        self._download_manager.add(url, self.get_path(), book_info)
         self.enable_button(True)
-        self.__book_downloader = None
 
-        if path is None:
+    def __download_added_cb(self, manager, item):
+        self._downloads_store.append([item.data['title'], 0, item])
+        self._downloads_scroller.show()
+
+    def __download_progress_cb(self, manager, item):
+        for row in self._downloads_store:
+            if row[2] is item:
+                row[1] = int(item.progress * 100)
+                break
+        self.progressbar.set_fraction(manager.get_progress())
+
+    def __download_finished_cb(self, manager, item):
+        for row in self._downloads_store:
+            if row[2] is item:
+                self._downloads_store.remove(row.iter)
+                break
+        if not manager.get_items():
+            self._downloads_scroller.hide()
+            self._allow_suspend()
+            GLib.timeout_add(500, self.progress_hide)
+        else:
+            self.progressbar.set_fraction(manager.get_progress())
+
+        title = item.data['title']
+        if item.state == downloadmanager.STATE_CANCELLED:
+            return
+
+        if item.path is None:
             self._show_error_alert(_('Error: Could not download %s. ' +
                     'The path in the catalog seems to be incorrect.') %
-                    self.selected_title)
+                    title)
             return
 
-        if os.stat(path).st_size == 0:
+        if os.stat(item.path).st_size == 0:
             self._show_error_alert(_('Error: Could not download %s. ' +
                     'The other end sent an empty file.') %
-                    self.selected_title)
+                    title)
             return
 
-        if content_type.startswith('text/html'):
+        if item.content_type.startswith('text/html'):
             self._show_error_alert(_('Error: Could not download %s. ' +
                     'The other end sent text/html instead of a book.') %
-                    self.selected_title)
+                    title)
             return
 
-        self.process_downloaded_book(path)
-
-    def __book_progress_cb(self, downloader, progress):
-        self.progressbar.set_fraction(progress)
-        while Gtk.events_pending():
-            Gtk.main_iteration()
+        self.process_downloaded_book(item.path, item.data)
 
     def clear_downloaded_bytes(self):
         self.progressbar.set_fraction(0.0)
 
-    def process_downloaded_book(self, path):
+    def process_downloaded_book(self, path, book_info):
         logging.debug("Got document %s", path)
-        self.create_journal_entry(path)
-        self._getter = None
-        self._allow_suspend()
+        self.create_journal_entry(path, book_info)
 
-    def create_journal_entry(self, path):
+    def _get_book_info(self):
+        '''
+        Returns what create_journal_entry needs to know about the selected
+        book
+        '''
+        textbuffer = self.textview.get_buffer()
+        book_info = {
+            'title': self.selected_title,
+            'author': self.selected_author,
+            'publisher': self.selected_publisher,
+            'summary': self.selected_summary,
+            'language': self.selected_language_code,
+            'mime_type': self.format_combo.props.value,
+            'source': self.source,
+            'description': textbuffer.get_text(textbuffer.get_start_iter(),
+                                               textbuffer.get_end_iter(),
+                                               True),
+            'preview': None,
+            'cover_image': None}
+        if self.exist_cover_image:
+            book_info['preview'] = self._cover_images.preview_png
+            book_info['cover_image'] = self._cover_images.cover_png
+        return book_info
+
+    def create_journal_entry(self, path, book_info):
         journal_entry = datastore.create()
-        journal_title = self.selected_title
-        if self.selected_author != '':
-            journal_title = journal_title + ', by ' + self.selected_author
+        journal_title = book_info['title']
+        if book_info['author'] != '':
+            journal_title = journal_title + ', by ' + book_info['author']
         journal_entry.metadata['title'] = journal_title
         journal_entry.metadata['title_set_by_user'] = '1'
         journal_entry.metadata['keep'] = '0'
-        journal_entry.metadata['mime_type'] = \
-                self.format_combo.props.value
+        journal_entry.metadata['mime_type'] = book_info['mime_type']
         # Fix fake mime type for black&white pdfs
         if journal_entry.metadata['mime_type'] == _MIMETYPES['PDF BW']:
             journal_entry.metadata['mime_type'] = _MIMETYPES['PDF']
 
         journal_entry.metadata['buddies'] = ''
         journal_entry.metadata['icon-color'] = profile.get_color().to_string()
-        textbuffer = self.textview.get_buffer()
-        journal_entry.metadata['description'] = \
-            textbuffer.get_text(textbuffer.get_start_iter(),
-                                textbuffer.get_end_iter(), True)
-        if self.exist_cover_image:
-            image_buffer = self._get_preview_image_buffer()
-            journal_entry.metadata['preview'] = dbus.ByteArray(image_buffer)
-            image_buffer = self._get_cover_image_buffer()
-            journal_entry.metadata['cover_image'] = \
-                dbus.ByteArray(base64.b64encode(image_buffer))
+        journal_entry.metadata['description'] = book_info['description']
+        if book_info['cover_image'] is not None:
+            journal_entry.metadata['preview'] = \
+                dbus.ByteArray(book_info['preview'])
+            journal_entry.metadata['cover_image'] = dbus.ByteArray(
+                base64.b64encode(book_info['cover_image']))
         else:
             journal_entry.metadata['cover_image'] = ""
 
-        journal_entry.metadata['tags'] = self.source
-        journal_entry.metadata['source'] = self.source
-        journal_entry.metadata['author'] = self.selected_author
-        journal_entry.metadata['publisher'] = self.selected_publisher
-        journal_entry.metadata['summary'] = self.selected_summary
-        journal_entry.metadata['language'] = self.selected_language_code
+        journal_entry.metadata['tags'] = book_info['source']
+        journal_entry.metadata['source'] = book_info['source']
+        journal_entry.metadata['author'] = book_info['author']
+        journal_entry.metadata['publisher'] = book_info['publisher']
+        journal_entry.metadata['summary'] = book_info['summary']
+        journal_entry.metadata['language'] = book_info['language']
 
         journal_entry.file_path = path
         datastore.write(journal_entry)
         os.remove(path)
-        self.progress_hide()
         self._object_id = journal_entry.object_id
-        self._show_journal_alert(_('Download completed'), self.selected_title)
+        self._show_journal_alert(_('Download completed'), book_info['title'])
 
     def _show_journal_alert(self, title, msg):
         _stop_alert = Alert()
@@ -1110,40 +1554,6 @@ class GetIABooksActivity(activity.Activity):
             launch_bundle(object_id=self._object_id)
         self.remove_alert(alert)
 
-    def _get_preview_image_buffer(self):
-        preview_width, preview_height = style.zoom(300), style.zoom(225)
-
-        pixbuf = self.image.get_pixbuf()
-        width, height = pixbuf.get_width(), pixbuf.get_height()
-
-        scale = 1
-        if (width > preview_width) or (height > preview_height):
-            scale_x = preview_width / float(width)
-            scale_y = preview_height / float(height)
-            scale = min(scale_x, scale_y)
-
-        pixbuf2 = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB,
-                pixbuf.get_has_alpha(), pixbuf.get_bits_per_sample(),
-                preview_width, preview_height)
-        pixbuf2.fill(style.COLOR_WHITE.get_int())
-
-        margin_x = int((preview_width - (width * scale)) / 2)
-        margin_y = int((preview_height - (height * scale)) / 2)
-
-        pixbuf.scale(pixbuf2, margin_x, margin_y,
-                preview_width - (margin_x * 2),
-                preview_height - (margin_y * 2),
-                margin_x, margin_y, scale, scale,
-                GdkPixbuf.InterpType.BILINEAR)
-
-        succes, data = pixbuf2.save_to_bufferv('png', [], [])
-        return data
-
-    def _get_cover_image_buffer(self):
-        pixbuf = self.image.get_pixbuf()
-        succes, data = pixbuf.save_to_bufferv('png', [], [])
-        return data
-
     def _show_error_alert(self, title, text=None):
         alert = NotifyAlert(timeout=20)
         alert.props.title = title
@@ -0,0 +1,288 @@
+#! /usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Sidecar index of a volume catalog.xml.
+
+catalog.idx holds the mtime and size of the catalog it was built from,
+the book and catalog records and the search index, in a layout that is
+read straight from a memory map:
+
+    header
+    record offsets   (books + catalogs + 1) x uint64
+    records          json, one per entry
+    feed             json
+    token table      n x (token offset, token length,
+                          postings offset, postings count)
+    tokens           utf-8, sorted
+    postings         n x (book number uint32, weight uint16)
+"""
+
+import json
+import logging
+import mmap
+import os
+import struct
+
+import opdsparser
+import searchindex
+
+INDEX_NAME = 'catalog.idx'
+
+_MAGIC = b'GBCIDX01'
+# magic, catalog mtime, catalog size, books, catalogs, tokens,
+# offsets of the record offsets, feed, feed length, token table
+_HEADER = struct.Struct('<8sdQIIIQQQQ')
+_OFFSET = struct.Struct('<Q')
+_TOKEN = struct.Struct('<QIQI')
+_POSTING = struct.Struct('<IH')
+
+_RECORD_KEYS = ('title', 'author', 'dcterms_language', 'dcterms_publisher',
+                'published', 'summary', 'id', 'links')
+
+
+def get_index_path(catalog_path):
+    return os.path.join(os.path.dirname(catalog_path), INDEX_NAME)
+
+
+def _split_entries(feed, entries):
+    # same rules as opds.QueryResult uses for the streamed entries
+    crawlable = opdsparser.is_crawlable(feed)
+    books = []
+    catalogs = []
+    for entry in entries:
+        kind = opdsparser.get_entry_kind(entry)
+        if crawlable or kind == opdsparser.KIND_CATALOG:
+            catalogs.append(entry)
+        elif kind == opdsparser.KIND_BOOK:
+            books.append(entry)
+    return books, catalogs
+
+
+def _encode(obj):
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def build(feed, entries, mtime, size):
+    '''
+    Returns the index of a parsed catalog as bytes
+    '''
+    books, catalogs = _split_entries(feed, entries)
+    index = searchindex.SearchIndex()
+    for number, entry in enumerate(books):
+        index.add(number,
+                  ((entry.get('title'), searchindex.WEIGHT_TITLE),
+                   (entry.get('author'), searchindex.WEIGHT_AUTHOR),
+                   (entry.get('dcterms_publisher'),
+                    searchindex.WEIGHT_PUBLISHER)))
+
+    records = [_encode(dict([(key, entry[key]) for key in _RECORD_KEYS
+                             if key in entry]))
+               for entry in books + catalogs]
+    feed_data = _encode({'title': feed.get('title', ''),
+                         'links': feed.get('links', [])})
+    postings = index.get_postings()
+    tokens = [token.encode('utf-8') for token, _ in postings]
+
+    offsets_start = _HEADER.size
+    records_start = offsets_start + _OFFSET.size * (len(records) + 1)
+    feed_start = records_start + sum([len(record) for record in records])
+    table_start = feed_start + len(feed_data)
+    tokens_start = table_start + _TOKEN.size * len(tokens)
+    postings_start = tokens_start + sum([len(token) for token in tokens])
+
+    header = _HEADER.pack(_MAGIC, mtime, size, len(books), len(catalogs),
+                          len(tokens), offsets_start, feed_start,
+                          len(feed_data), table_start)
+    chunks = [header]
+    position = records_start
+    for record in records:
+        chunks.append(_OFFSET.pack(position))
+        position += len(record)
+    chunks.append(_OFFSET.pack(position))
+    chunks.extend(records)
+    chunks.append(feed_data)
+
+    token_position = tokens_start
+    postings_position = postings_start
+    for token, (_, token_postings) in zip(tokens, postings):
+        chunks.append(_TOKEN.pack(token_position, len(token),
+                                  postings_position, len(token_postings)))
+        token_position += len(token)
+        postings_position += _POSTING.size * len(token_postings)
+    chunks.extend(tokens)
+    for _, token_postings in postings:
+        for number in sorted(token_postings):
+            chunks.append(_POSTING.pack(number,
+                                        min(token_postings[number], 0xffff)))
+    return b''.join(chunks)
+
+
+def build_from_catalog(catalog_path):
+    '''
+    Parses catalog_path and returns its index as bytes
+    '''
+    stat = os.stat(catalog_path)
+    feedobj = opdsparser.parse_incremental(catalog_path,
+                                           lambda feed, entries: None)
+    if feedobj.get('bozo'):
+        raise feedobj['bozo_exception']
+    return build(feedobj['feed'], feedobj['entries'], stat.st_mtime,
+                 stat.st_size)
+
+
+def write(index_path, data):
+    temp_path = index_path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.rename(temp_path, index_path)
+
+
+class _MappedSearchIndex(searchindex.SearchIndex):
+    """The search index section of a catalog.idx, items are book numbers."""
+
+    def __init__(self, buf, books, tokens, table_start):
+        searchindex.SearchIndex.__init__(self)
+        self._buf = buf
+        self._books = books
+        self._token_count = tokens
+        self._table_start = table_start
+
+    def __len__(self):
+        return self._books
+
+    def _get_item(self, number):
+        return number
+
+    def _get_token(self, position):
+        offset, length, postings_offset, postings_count = \
+                _TOKEN.unpack_from(self._buf,
+                                   self._table_start + _TOKEN.size * position)
+        return self._buf[offset:offset + length], postings_offset, \
+                postings_count
+
+    def _lookup(self, word):
+        word = word.encode('utf-8')
+        low, high = 0, self._token_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._get_token(middle)[0] < word:
+                low = middle + 1
+            else:
+                high = middle
+        scores = {}
+        for position in range(low, self._token_count):
+            token, postings_offset, postings_count = self._get_token(position)
+            if not token.startswith(word):
+                break
+            bonus = searchindex.EXACT_BONUS if token == word else 1
+            end = postings_offset + _POSTING.size * postings_count
+            for number, weight in _POSTING.iter_unpack(
+                    self._buf[postings_offset:end]):
+                score = weight * bonus
+                if scores.get(number, 0) < score:
+                    scores[number] = score
+        return scores
+
+
+class CatalogIndex(object):
+    """A catalog.idx read from a memory map (or from bytes)."""
+
+    def __init__(self, buf):
+        if len(buf) < _HEADER.size:
+            raise ValueError('Truncated catalog index')
+        magic, self._mtime, self._size, self._books, self._catalogs, \
+                tokens, self._offsets_start, feed_start, feed_length, \
+                table_start = _HEADER.unpack_from(buf, 0)
+        if magic != _MAGIC:
+            raise ValueError('Not a catalog index')
+        self._buf = buf
+        self._feed_range = (feed_start, feed_start + feed_length)
+        self._search_index = _MappedSearchIndex(buf, self._books, tokens,
+                                                table_start)
+
+    def is_current(self, stat):
+        '''
+        Returns True if the index was built from a catalog with the
+        mtime and size of stat
+        '''
+        return self._mtime == stat.st_mtime and self._size == stat.st_size
+
+    def __len__(self):
+        return self._books
+
+    def _get_record(self, number):
+        start, end = struct.unpack_from('<QQ', self._buf,
+                self._offsets_start + _OFFSET.size * number)
+        return json.loads(self._buf[start:end].decode('utf-8'))
+
+    def get_book_record(self, number):
+        '''
+        Returns the entry dict of the book number
+        '''
+        return self._get_record(number)
+
+    def get_catalog_records(self):
+        return [self._get_record(self._books + number)
+                for number in range(self._catalogs)]
+
+    def get_feed(self):
+        start, end = self._feed_range
+        return json.loads(self._buf[start:end].decode('utf-8'))
+
+    def search(self, query):
+        '''
+        Returns the numbers of the matching books, best first
+        '''
+        return self._search_index.search(query)
+
+    def close(self):
+        '''
+        Unmaps the index, reading it afterwards raises ValueError
+        '''
+        if isinstance(self._buf, mmap.mmap):
+            self._buf.close()
+
+
+def open_index(index_path):
+    '''
+    Maps index_path, returns a CatalogIndex or None if it can not be read
+    '''
+    try:
+        with open(index_path, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return CatalogIndex(buf)
+    except (OSError, ValueError, struct.error) as e:
+        logging.debug('Can not read %s: %s', index_path, e)
+        return None
+
+
+def load(catalog_path):
+    '''
+    Returns the CatalogIndex of catalog_path, built again (and saved
+    when the volume is writable) if catalog.idx is missing or stale
+    '''
+    stat = os.stat(catalog_path)
+    index_path = get_index_path(catalog_path)
+    index = open_index(index_path)
+    if index is not None and index.is_current(stat):
+        return index
+    logging.debug('Building the index of %s', catalog_path)
+    data = build_from_catalog(catalog_path)
+    try:
+        write(index_path, data)
+    except OSError as e:
+        logging.debug('Can not save %s: %s', index_path, e)
+    return CatalogIndex(data)
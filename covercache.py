@@ -0,0 +1,204 @@
+#! /usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import collections
+import hashlib
+import logging
+import os
+import pickle
+import shutil
+import threading
+
+import workers
+
+_MAX_BYTES = 20 * 1024 * 1024
+_INDEX_NAME = 'index'
+
+
+class CoverCache(object):
+    """On-disk store of downloaded cover images, keyed by URL.
+
+    The cache keeps at most max_bytes of images, the least recently used
+    ones are removed first.  The use order is saved in an index file so it
+    survives restarts.  load() and save() read and write the disk, they
+    are meant to run in a worker (LoadTask, SaveTask); until the index is
+    loaded get() finds nothing.
+    """
+
+    def __init__(self, path, max_bytes=_MAX_BYTES):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # only one index is written at a time
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        # url -> size, least recently used first
+        self._entries = None
+        self._size = 0
+        # images stored before the index was loaded
+        self._pending = collections.OrderedDict()
+
+    def load(self):
+        '''
+        Reads the index and removes the images it does not know about
+        '''
+        with self._lock:
+            if self._entries is not None:
+                return
+        # read without the lock, get() and store() do not wait for it
+        if not os.path.exists(self._path):
+            os.makedirs(self._path, exist_ok=True)
+        entries = self._load_index()
+        with self._lock:
+            for url, size in self._pending.items():
+                entries.pop(url, None)
+                entries[url] = size
+            self._pending = collections.OrderedDict()
+            self._entries = entries
+            self._size = sum(entries.values())
+            self._evict()
+            self._dirty = True
+
+    def _get_file_name(self, url):
+        return os.path.join(self._path,
+                            hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def _load_index(self):
+        index_path = os.path.join(self._path, _INDEX_NAME)
+        try:
+            with open(index_path, 'rb') as f:
+                entries = pickle.load(f)
+        except (IOError, OSError):
+            entries = {}
+        except Exception as e:
+            logging.warning('Discarding broken cover cache index: %s', e)
+            entries = {}
+        # images removed behind our back are forgotten, and images the
+        # index does not know about (saved before a crash) removed
+        entries = collections.OrderedDict(
+                [(url, size) for url, size in entries.items()
+                 if os.path.exists(self._get_file_name(url))])
+        known = set([os.path.basename(self._get_file_name(url))
+                     for url in entries])
+        for name in os.listdir(self._path):
+            if name == _INDEX_NAME or name in known:
+                continue
+            with self._lock:
+                # stored while the index was read
+                if name in [os.path.basename(self._get_file_name(url))
+                            for url in self._pending]:
+                    continue
+                try:
+                    os.remove(os.path.join(self._path, name))
+                except OSError:
+                    pass
+        return entries
+
+    def get(self, url):
+        '''
+        Returns the path of the cached image of url, or None
+        '''
+        with self._lock:
+            if self._entries is None:
+                if url in self._pending:
+                    return self._get_file_name(url)
+                return None
+            if url not in self._entries:
+                return None
+            file_name = self._get_file_name(url)
+            if not os.path.exists(file_name):
+                self._size -= self._entries.pop(url)
+                self._dirty = True
+                return None
+            self._entries.move_to_end(url)
+            self._dirty = True
+            return file_name
+
+    def store(self, url, path):
+        '''
+        Moves the downloaded image at path into the cache, returns the
+        path of the cached image
+        '''
+        file_name = self._get_file_name(url)
+        size = os.path.getsize(path)
+        with self._lock:
+            if self._entries is None:
+                # added to the index once it is loaded
+                if not os.path.exists(self._path):
+                    os.makedirs(self._path, exist_ok=True)
+                shutil.move(path, file_name)
+                self._pending.pop(url, None)
+                self._pending[url] = size
+                return file_name
+            shutil.move(path, file_name)
+            self._size += size - self._entries.pop(url, 0)
+            self._entries[url] = size
+            self._evict()
+            self._dirty = True
+        return file_name
+
+    def _evict(self):
+        # the image just stored is kept even if it is bigger than the quota
+        while self._size > self._max_bytes and len(self._entries) > 1:
+            url, size = self._entries.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(self._get_file_name(url))
+            except OSError:
+                pass
+
+    def save(self):
+        '''
+        Writes the index if it changed
+        '''
+        index_path = os.path.join(self._path, _INDEX_NAME)
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty or self._entries is None:
+                    return
+                entries = collections.OrderedDict(self._entries)
+                self._dirty = False
+            try:
+                with open(index_path + '.tmp', 'wb') as f:
+                    pickle.dump(entries, f, pickle.HIGHEST_PROTOCOL)
+                os.rename(index_path + '.tmp', index_path)
+            except (IOError, OSError) as e:
+                logging.warning('Could not save the cover cache index: %s',
+                                e)
+                with self._lock:
+                    self._dirty = True
+
+
+class LoadTask(workers.Task):
+    """Reads the index of a CoverCache in a worker."""
+
+    def __init__(self, cover_cache):
+        workers.Task.__init__(self)
+        self._cover_cache = cover_cache
+
+    def run(self):
+        self._cover_cache.load()
+
+
+class SaveTask(workers.Task):
+    """Writes the index of a CoverCache in a worker."""
+
+    def __init__(self, cover_cache):
+        workers.Task.__init__(self)
+        self._cover_cache = cover_cache
+
+    def run(self):
+        self._cover_cache.save()
@@ -0,0 +1,163 @@
+#! /usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import collections
+import logging
+
+from gi.repository import GdkPixbuf
+from gi.repository import GLib
+
+import opds
+import workers
+
+_CACHE_SIZE = 32
+
+
+class CoverImages(object):
+    """The images made from a cover: the pixbuf shown in the book panel,
+    and the preview and cover PNGs saved with the journal entry."""
+
+    __slots__ = ('pixbuf', 'preview_png', 'cover_png')
+
+    def __init__(self, pixbuf, preview_png, cover_png):
+        self.pixbuf = pixbuf
+        self.preview_png = preview_png
+        self.cover_png = cover_png
+
+
+def _fit(width, height, max_width, max_height):
+    # images are made smaller to fit, never bigger
+    if width <= max_width and height <= max_height:
+        return width, height
+    scale = min(max_width / float(width), max_height / float(height))
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def _center(pixbuf, width, height, color):
+    # pixbuf on a width x height background of color
+    framed = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB,
+            pixbuf.get_has_alpha(), pixbuf.get_bits_per_sample(),
+            width, height)
+    framed.fill(color)
+    image_width, image_height = _fit(pixbuf.get_width(),
+                                     pixbuf.get_height(), width, height)
+    if (image_width, image_height) != (pixbuf.get_width(),
+                                       pixbuf.get_height()):
+        pixbuf = pixbuf.scale_simple(image_width, image_height,
+                                     GdkPixbuf.InterpType.BILINEAR)
+    pixbuf.copy_area(0, 0, image_width, image_height, framed,
+                     (width - image_width) // 2,
+                     (height - image_height) // 2)
+    return framed
+
+
+def _decode(data, max_width, max_height):
+    loader = GdkPixbuf.PixbufLoader()
+
+    def size_prepared_cb(loader, width, height):
+        # let the decoder scale down while it reads the image
+        loader.set_size(*_fit(width, height, max_width, max_height))
+
+    loader.connect('size-prepared', size_prepared_cb)
+    try:
+        loader.write(data)
+    finally:
+        loader.close()
+    return loader.get_pixbuf()
+
+
+def _to_png(pixbuf):
+    succes, data = pixbuf.save_to_bufferv('png', [], [])
+    return data
+
+
+class CoverImagesTask(workers.Task):
+
+    def __init__(self, key, path, data, sizes, ready_cb, user_data=None):
+        workers.Task.__init__(self)
+        self._key = key
+        self._user_data = user_data
+        self._path = path
+        self._data = data
+        self._sizes = sizes
+        self._ready_cb = ready_cb
+
+    def run(self):
+        (panel_width, panel_height, panel_color,
+         preview_width, preview_height, preview_color) = self._sizes
+        images = None
+        try:
+            data = self._data
+            if data is None:
+                with open(self._path, 'rb') as f:
+                    data = f.read()
+            pixbuf = _center(_decode(data, panel_width, panel_height),
+                             panel_width, panel_height, panel_color)
+            preview = _center(pixbuf, preview_width, preview_height,
+                              preview_color)
+            images = CoverImages(pixbuf, _to_png(preview), _to_png(pixbuf))
+        except Exception as e:
+            logging.error('Can not load the cover %s: %s', self._key, e)
+        if not self.is_stopped():
+            GLib.idle_add(self._ready_cb, self._key, images, self._user_data)
+
+
+class CoverRenderer(object):
+    """Makes CoverImages on the covers queue and keeps the last ones.
+
+    ready_cb(key, images, user_data) is called from the main loop, images
+    is None if the cover could not be read.
+    """
+
+    def __init__(self, panel_size, panel_color, preview_size, preview_color,
+                 cache_size=_CACHE_SIZE):
+        self._sizes = panel_size + (panel_color,) + preview_size + \
+                (preview_color,)
+        self._cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._task = None
+
+    def get(self, key):
+        '''
+        Returns the CoverImages made for key, or None
+        '''
+        images = self._cache.get(key)
+        if images is not None:
+            self._cache.move_to_end(key)
+        return images
+
+    def render(self, key, ready_cb, path=None, data=None, user_data=None):
+        '''
+        Reads the image from the file path or the bytes data; a render
+        still queued is cancelled
+        '''
+        self.cancel()
+
+        def __ready_cb(key, images, user_data):
+            if images is not None:
+                self._cache[key] = images
+                while len(self._cache) > self._cache_size:
+                    self._cache.popitem(last=False)
+            ready_cb(key, images, user_data)
+
+        self._task = CoverImagesTask(key, path, data, self._sizes, __ready_cb,
+                                     user_data)
+        opds.get_worker_pool().submit(workers.QUEUE_COVERS, self._task)
+
+    def cancel(self):
+        if self._task is not None:
+            self._task.stop()
+            self._task = None
@@ -19,6 +19,7 @@
 import os
 import logging
 
+from gi.repository import GLib
 from gi.repository import GObject
 from gi.repository import Gio
 
@@ -29,6 +30,9 @@ class DeviceManager(GObject.GObject):
         'device-changed': (GObject.SignalFlags.RUN_FIRST,
                           None,
                           ([])),
+        'device-removed': (GObject.SignalFlags.RUN_FIRST,
+                          None,
+                          ([str])),
     }
 
     def __init__(self):
@@ -40,13 +44,18 @@ class DeviceManager(GObject.GObject):
         self.volume_monitor.connect('mount-added', self._mount_added_cb)
         self.volume_monitor.connect('mount-removed', self._mount_removed_cb)
 
-        self._populate_devices()
+        # looking for catalogs on slow volumes waits until the window is
+        # painted
+        GLib.idle_add(self._populate_devices, priority=GLib.PRIORITY_LOW)
 
     def _populate_devices(self):
         for mount in self.volume_monitor.get_mounts():
             props = self._get_props_from_device(mount)
             if mount.can_eject() and props['have_catalog']:
                 self._devices[mount] = props
+        if self._devices:
+            self.emit('device-changed')
+        return False
 
     def _get_props_from_device(self, mount):
         props = {}
@@ -68,7 +77,10 @@ class DeviceManager(GObject.GObject):
             self.emit('device-changed')
 
     def _mount_removed_cb(self, volume_monitor, device):
-        del self._devices[device]
+        props = self._devices.pop(device, None)
+        if props is None:
+            props = self._get_props_from_device(device)
+        self.emit('device-removed', props['mount_path'])
         self.emit('device-changed')
 
     def get_devices(self):
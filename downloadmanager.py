@@ -0,0 +1,180 @@
+#! /usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import logging
+import urllib.parse
+
+from gi.repository import GObject
+
+import opds
+import workers
+
+STATE_QUEUED = 'queued'
+STATE_RUNNING = 'running'
+STATE_DONE = 'done'
+STATE_FAILED = 'failed'
+STATE_CANCELLED = 'cancelled'
+
+_DEFAULT_MAX_DOWNLOADS = 2
+_DEFAULT_DOWNLOADS_PER_HOST = 2
+_DEFAULT_SEGMENTS = 3
+
+
+class DownloadItem(object):
+    """A book in the download queue.
+
+    data is whatever the caller needs once the file is there.  When the
+    item is finished path is the downloaded file, or None if the download
+    failed or was cancelled.
+    """
+
+    def __init__(self, url, path, data):
+        self.url = url
+        self.path = path
+        self.data = data
+        self.state = STATE_QUEUED
+        self.progress = 0.0
+        self.content_type = None
+        self.host = urllib.parse.urlparse(url)[1]
+        self.downloader = None
+        # connections to the host the download may open at once
+        self.connections = 0
+
+    def is_active(self):
+        return self.state in (STATE_QUEUED, STATE_RUNNING)
+
+
+class DownloadManager(GObject.GObject):
+    """Queue of book downloads run on opds.FileDownloader.
+
+    At most max_downloads files are transferred at the same time, over at
+    most downloads_per_host connections to the same host; the rest wait in
+    the order they were added.  Big files are fetched in up to segments
+    byte ranges at once when the server allows it, each range taking one
+    of the connections of its host.
+    """
+
+    __gsignals__ = {
+        'item-added': (GObject.SignalFlags.RUN_FIRST,
+                       None,
+                       ([GObject.TYPE_PYOBJECT])),
+        'item-progress': (GObject.SignalFlags.RUN_FIRST,
+                          None,
+                          ([GObject.TYPE_PYOBJECT])),
+        'item-finished': (GObject.SignalFlags.RUN_FIRST,
+                          None,
+                          ([GObject.TYPE_PYOBJECT])),
+    }
+
+    def __init__(self, max_downloads=_DEFAULT_MAX_DOWNLOADS,
+                 downloads_per_host=_DEFAULT_DOWNLOADS_PER_HOST,
+                 segments=_DEFAULT_SEGMENTS):
+        GObject.GObject.__init__(self)
+        self._max_downloads = max_downloads
+        self._downloads_per_host = downloads_per_host
+        self._segments = segments
+        self._items = []
+        # items finished since the queue was last empty
+        self._finished = 0
+
+    def add(self, url, path, data=None):
+        '''
+        Queues the download of url to path, returns the DownloadItem.
+        A url that is already queued is not added again.
+        '''
+        for item in self._items:
+            if item.url == url:
+                return item
+        item = DownloadItem(url, path, data)
+        self._items.append(item)
+        self.emit('item-added', item)
+        self._schedule()
+        return item
+
+    def cancel(self, item):
+        if not item.is_active():
+            return
+        if item.downloader is not None:
+            item.downloader.stop()
+        self.__finish(item, STATE_CANCELLED, None, None)
+
+    def cancel_all(self):
+        for item in list(self._items):
+            self.cancel(item)
+
+    def get_items(self):
+        '''
+        Returns the queued and running items
+        '''
+        return list(self._items)
+
+    def get_progress(self):
+        '''
+        Returns the combined progress of the items added since the queue
+        was last empty
+        '''
+        if not self._items:
+            return 0.0
+        done = self._finished + sum([item.progress for item in self._items])
+        return done / (self._finished + len(self._items))
+
+    def _schedule(self):
+        running = [item for item in self._items
+                   if item.state == STATE_RUNNING]
+        for item in self._items:
+            if len(running) >= self._max_downloads:
+                break
+            if item.state != STATE_QUEUED:
+                continue
+            on_host = sum([other.connections for other in running
+                           if other.host == item.host])
+            free = self._downloads_per_host - on_host
+            if free < 1:
+                continue
+            logging.debug('Starting download of %s', item.url)
+            item.state = STATE_RUNNING
+            item.connections = max(1, min(self._segments, free))
+            # interrupted books are resumed where they stopped
+            item.downloader = opds.FileDownloader(item.url, item.path,
+                                                  workers.QUEUE_BOOKS,
+                                                  resumable=True,
+                                                  segments=item.connections)
+            item.downloader.connect('updated', self.__updated_cb, item)
+            item.downloader.connect('progress', self.__progress_cb, item)
+            running.append(item)
+
+    def __updated_cb(self, downloader, path, content_type, item):
+        if path is None:
+            self.__finish(item, STATE_FAILED, None, None)
+        else:
+            self.__finish(item, STATE_DONE, path, content_type)
+
+    def __progress_cb(self, downloader, progress, item):
+        item.progress = progress
+        self.emit('item-progress', item)
+
+    def __finish(self, item, state, path, content_type):
+        item.state = state
+        item.path = path
+        item.content_type = content_type
+        item.downloader = None
+        item.connections = 0
+        if state == STATE_DONE:
+            item.progress = 1.0
+        self._items.remove(item)
+        self._finished = self._finished + 1 if self._items else 0
+        self.emit('item-finished', item)
+        self._schedule()
@@ -0,0 +1,104 @@
+#! /usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import logging
+import hashlib
+import pickle
+import threading
+
+_MAX_FEEDS = 200
+
+
+class FeedCache(object):
+    """On-disk store of parsed feeds and their HTTP validators.
+
+    Every feed is kept in its own file, keyed by the feed URI and the
+    Accept-Language sent with the request.
+    """
+
+    def __init__(self, path, max_feeds=_MAX_FEEDS):
+        self._path = path
+        self._max_feeds = max_feeds
+        self._lock = threading.Lock()
+        if not os.path.exists(self._path):
+            os.makedirs(self._path)
+
+    def _get_file_name(self, uri, language):
+        key = '%s\n%s' % (uri, language or '')
+        return os.path.join(self._path,
+                            hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, uri, language=None):
+        '''
+        Returns a dict with the 'etag', 'modified', 'feed' and 'entries'
+        stored for the uri, or None if it is not cached
+        '''
+        file_name = self._get_file_name(uri, language)
+        try:
+            with open(file_name, 'rb') as f:
+                cached = pickle.load(f)
+        except (IOError, OSError):
+            return None
+        except Exception as e:
+            logging.warning('Discarding broken feed cache %s: %s',
+                            file_name, e)
+            self._remove(file_name)
+            return None
+        if cached.get('uri') != uri:
+            return None
+        os.utime(file_name, None)
+        return cached
+
+    def store(self, uri, language, feedobj):
+        '''
+        Stores the validators and the parsed entries of feedobj, feeds
+        without an ETag or Last-Modified header are not cached
+        '''
+        if 'etag' not in feedobj and 'modified' not in feedobj:
+            return
+        cached = {'uri': uri,
+                  'etag': feedobj.get('etag'),
+                  'modified': feedobj.get('modified'),
+                  'feed': feedobj['feed'],
+                  'entries': feedobj['entries']}
+        file_name = self._get_file_name(uri, language)
+        with self._lock:
+            try:
+                with open(file_name + '.tmp', 'wb') as f:
+                    pickle.dump(cached, f, pickle.HIGHEST_PROTOCOL)
+                os.rename(file_name + '.tmp', file_name)
+            except (IOError, OSError) as e:
+                logging.warning('Could not cache feed %s: %s', uri, e)
+                self._remove(file_name + '.tmp')
+                return
+            self._prune()
+
+    def _prune(self):
+        names = [os.path.join(self._path, name)
+                 for name in os.listdir(self._path)
+                 if not name.endswith('.tmp')]
+        if len(names) <= self._max_feeds:
+            return
+        names.sort(key=os.path.getmtime)
+        for file_name in names[:len(names) - self._max_feeds]:
+            self._remove(file_name)
+
+    def _remove(self, file_name):
+        try:
+            os.remove(file_name)
+        except OSError:
+            pass
@@ -135,7 +135,7 @@ ACCEPTABLE_URI_SCHEMES = (
 #ACCEPTABLE_URI_SCHEMES = ()
 
 # ---------- required modules (should come with any Python distribution) ----------
-import sgmllib, re, sys, copy, urllib.parse, time, types, cgi, urllib.request, urllib.parse, urllib.error, urllib.request, urllib.error, urllib.parse, datetime
+import sgmllib, re, sys, copy, urllib.parse, time, types, cgi, urllib.request, urllib.parse, urllib.error, urllib.request, urllib.error, urllib.parse, urllib.response, datetime
 try:
     from io import BytesIO as _StringIO
 except ImportError:
@@ -2786,17 +2786,15 @@ def _sanitizeHTML(htmlSource, encoding, _type):
 
 class _FeedURLHandler(urllib.request.HTTPDigestAuthHandler, urllib.request.HTTPRedirectHandler, urllib.request.HTTPDefaultErrorHandler):
     def http_error_default(self, req, fp, code, msg, headers):
-        if ((code / 100) == 3) and (code != 304):
+        if ((code // 100) == 3) and (code != 304):
             return self.http_error_302(req, fp, code, msg, headers)
-        infourl = urllib.addinfourl(fp, headers, req.get_full_url())
-        infourl.status = code
-        return infourl
+        return urllib.response.addinfourl(fp, headers, req.get_full_url(), code)
 
     def http_error_302(self, req, fp, code, msg, headers):
         if 'location' in headers:
             infourl = urllib.request.HTTPRedirectHandler.http_error_302(self, req, fp, code, msg, headers)
         else:
-            infourl = urllib.addinfourl(fp, headers, req.get_full_url())
+            infourl = urllib.response.addinfourl(fp, headers, req.get_full_url(), code)
         if not hasattr(infourl, 'status'):
             infourl.status = code
         return infourl
@@ -2805,7 +2803,7 @@ class _FeedURLHandler(urllib.request.HTTPDigestAuthHandler, urllib.request.HTTPR
         if 'location' in headers:
             infourl = urllib.request.HTTPRedirectHandler.http_error_301(self, req, fp, code, msg, headers)
         else:
-            infourl = urllib.addinfourl(fp, headers, req.get_full_url())
+            infourl = urllib.response.addinfourl(fp, headers, req.get_full_url(), code)
         if not hasattr(infourl, 'status'):
             infourl.status = code
         return infourl
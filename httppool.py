@@ -0,0 +1,300 @@
+#! /usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import errno
+import http.client
+import logging
+import os
+import select
+import socket
+import threading
+import time
+import urllib.request, urllib.error
+
+_DEFAULT_CONNECTIONS_PER_HOST = 2
+_DEFAULT_TIMEOUT = 60
+# seconds between the checks of the cancel token while connecting
+_CONNECT_POLL = 0.1
+
+
+def _is_cancelled(cancel_token):
+    return cancel_token is not None and cancel_token.is_cancelled()
+
+
+def _create_connection(address, timeout, source_address, cancel_token):
+    # socket.create_connection() that gives up as soon as cancel_token
+    # is cancelled
+    if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+        timeout = socket.getdefaulttimeout()
+    host, port = address
+    error = None
+    for family, socktype, proto, canonname, sockaddr in \
+            socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
+        sock = socket.socket(family, socktype, proto)
+        try:
+            if source_address:
+                sock.bind(source_address)
+            sock.setblocking(False)
+            start = time.time()
+            result = sock.connect_ex(sockaddr)
+            while result in (errno.EINPROGRESS, errno.EWOULDBLOCK,
+                             errno.EALREADY):
+                if cancel_token.is_cancelled():
+                    raise ConnectionAbortedError('Request cancelled')
+                if timeout is not None and time.time() - start > timeout:
+                    raise socket.timeout('timed out')
+                if select.select([], [sock], [], _CONNECT_POLL)[1]:
+                    result = sock.getsockopt(socket.SOL_SOCKET,
+                                             socket.SO_ERROR)
+            if result != 0:
+                raise OSError(result, os.strerror(result))
+            sock.settimeout(timeout)
+            return sock
+        except ConnectionAbortedError:
+            sock.close()
+            raise
+        except OSError as e:
+            sock.close()
+            error = e
+    raise error or OSError('getaddrinfo returned an empty list')
+
+
+class _RequestAborter(object):
+    """Registered with a CancelToken while a request waits for its
+    response; abort() makes a blocked send or read fail."""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def abort(self):
+        sock = self.connection.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class ConnectionPool(object):
+    """Keeps HTTP/1.1 connections open and reuses them per host.
+
+    urlopen() works like urllib.request.urlopen(); the connection behind
+    the response goes back to the pool when the response has been read
+    completely and closed.
+    """
+
+    def __init__(self, connections_per_host=_DEFAULT_CONNECTIONS_PER_HOST,
+                 timeout=_DEFAULT_TIMEOUT):
+        self._connections_per_host = connections_per_host
+        self._timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._opener = urllib.request.build_opener(*self.get_handlers())
+
+    def get_handlers(self, cancel_token=None):
+        '''
+        Returns the urllib handlers that open http(s) urls on this pool.
+        Cancelling cancel_token, a workers.CancelToken, aborts a request
+        still connecting or waiting for the response.
+        '''
+        return [PooledHTTPHandler(self, cancel_token),
+                PooledHTTPSHandler(self, cancel_token)]
+
+    def urlopen(self, url, timeout=None, cancel_token=None):
+        '''
+        Opens url (a string or a urllib.request.Request)
+        '''
+        opener = self._opener
+        if cancel_token is not None:
+            opener = urllib.request.build_opener(
+                    *self.get_handlers(cancel_token))
+        return opener.open(url, timeout=timeout or self._timeout)
+
+    def _get_connection(self, key, http_class, timeout):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return http_class(key[1], timeout=timeout), False
+
+    def _release(self, key, connection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self._connections_per_host:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        '''
+        Closes all the idle connections
+        '''
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def _send(self, connection, req, headers, cancel_token):
+        # http.client opens the socket with _create_connection(), also
+        # when a kept-alive connection has to be opened again
+        if cancel_token is None:
+            connection._create_connection = socket.create_connection
+        else:
+            connection._create_connection = \
+                    lambda address, timeout, source_address=None: \
+                    _create_connection(address, timeout, source_address,
+                                       cancel_token)
+        connection.request(req.get_method(), req.selector, req.data,
+                           headers)
+        return connection.getresponse()
+
+    def do_request(self, http_class, req, cancel_token=None):
+        host = req.host
+        if not host:
+            raise urllib.error.URLError('no host given')
+        key = (http_class.__name__, host)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update({k: v for k, v in req.headers.items()
+                        if k not in headers})
+        headers = {name.title(): val for name, val in headers.items()}
+        headers.pop('Connection', None)
+
+        connection, reused = self._get_connection(key, http_class,
+                                                  req.timeout)
+        # the response is registered by the caller, the connection goes
+        # back to the pool and must not be aborted afterwards
+        aborter = _RequestAborter(connection)
+        if cancel_token is not None:
+            cancel_token.register(aborter)
+        try:
+            response = self._send(connection, req, headers, cancel_token)
+        except (http.client.RemoteDisconnected, ConnectionError,
+                http.client.BadStatusLine) as err:
+            connection.close()
+            if not reused or _is_cancelled(cancel_token):
+                raise urllib.error.URLError(err)
+            # the server dropped a kept-alive connection, try a new one
+            logging.debug('Reconnecting to %s', host)
+            connection = http_class(host, timeout=req.timeout)
+            aborter.connection = connection
+            try:
+                response = self._send(connection, req, headers,
+                                      cancel_token)
+            except OSError as err:
+                connection.close()
+                raise urllib.error.URLError(err)
+        except OSError as err:
+            connection.close()
+            raise urllib.error.URLError(err)
+        except:
+            connection.close()
+            raise
+        finally:
+            if cancel_token is not None:
+                cancel_token.unregister(aborter)
+
+        response.url = req.get_full_url()
+        response.msg = response.reason
+        return PooledResponse(self, key, connection, response)
+
+
+class PooledResponse(object):
+    """http.client.HTTPResponse that gives its connection back on close."""
+
+    def __init__(self, pool, key, connection, response):
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._response = response
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def __iter__(self):
+        return iter(self._response)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, amt=None):
+        return self._response.read(amt)
+
+    def read1(self, n=-1):
+        return self._response.read1(n)
+
+    def readline(self, limit=-1):
+        return self._response.readline(limit)
+
+    def readinto(self, b):
+        return self._response.readinto(b)
+
+    def abort(self):
+        '''
+        Makes a read blocked in another thread fail, the connection is
+        not reused
+        '''
+        connection = self._connection
+        if connection is not None and connection.sock is not None:
+            try:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def close(self):
+        connection, self._connection = self._connection, None
+        if connection is None:
+            return
+        response = self._response
+        # read1() does not close the response when the body has been read
+        complete = response.isclosed() or response.length == 0
+        response.close()
+        if complete and not response.will_close:
+            self._pool._release(self._key, connection)
+        else:
+            connection.close()
+
+
+class PooledHTTPHandler(urllib.request.HTTPHandler):
+
+    def __init__(self, pool, cancel_token=None):
+        urllib.request.HTTPHandler.__init__(self)
+        self._pool = pool
+        self._cancel_token = cancel_token
+
+    def http_open(self, req):
+        if req._tunnel_host:
+            return urllib.request.HTTPHandler.http_open(self, req)
+        return self._pool.do_request(http.client.HTTPConnection, req,
+                                     self._cancel_token)
+
+
+class PooledHTTPSHandler(urllib.request.HTTPSHandler):
+
+    def __init__(self, pool, cancel_token=None):
+        urllib.request.HTTPSHandler.__init__(self)
+        self._pool = pool
+        self._cancel_token = cancel_token
+
+    def https_open(self, req):
+        if req._tunnel_host:
+            return urllib.request.HTTPSHandler.https_open(self, req)
+        return self._pool.do_request(http.client.HTTPSConnection, req,
+                                     self._cancel_token)
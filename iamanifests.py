@@ -0,0 +1,167 @@
+#! /usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""The {identifier}_files.xml manifests of the Internet Archive.
+
+Only what the activity needs is kept from a manifest: for every content
+type it can download, the name and size of the file to get.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+# formats listed in the manifests -> content types of the books
+FORMATS = {
+    'text pdf': 'application/pdf',
+    'grayscale luratech pdf': 'application/pdf-bw',
+    'image container pdf': 'application/pdf',
+    'djvu': 'image/x.djvu',
+    'epub': 'application/epub+zip',
+}
+
+# the files of an item rarely change, a day old list is good enough
+_TTL = 24 * 60 * 60
+_MAX_MANIFESTS = 500
+
+
+def get_url(identifier):
+    return 'http://archive.org/download/%s/%s_files.xml' % (identifier,
+                                                            identifier)
+
+
+class ManifestParser(object):
+    """Parses a manifest from the chunks given to feed().
+
+    files is {content type: (file name, size)}, size is None if the
+    manifest does not list it.  Only content_types, the formats the item
+    is said to have, are waited for; all of them by default.
+    """
+
+    def __init__(self, content_types=None):
+        from xml.etree import ElementTree
+        self._parser = ElementTree.XMLPullParser()
+        self._content_types = set(FORMATS.values())
+        if content_types:
+            self._content_types &= set(content_types)
+        if not self._content_types:
+            self._content_types = set(FORMATS.values())
+        self._found_all = False
+        self.files = {}
+
+    def feed(self, data):
+        '''
+        Returns True as soon as a file of every content type waited for
+        was found, the rest of the manifest is not needed then
+        '''
+        self._parser.feed(data)
+        for event, element in self._parser.read_events():
+            if element.tag != 'file':
+                continue
+            content_type = FORMATS.get(
+                    (element.findtext('format') or '').lower())
+            if content_type is not None and content_type not in self.files:
+                size = element.findtext('size')
+                self.files[content_type] = (element.get('name'),
+                        int(size) if size and size.isdigit() else None)
+            element.clear()
+        self._found_all = self._content_types.issubset(self.files)
+        return self._found_all
+
+    def close(self):
+        '''
+        Checks that the manifest was well formed, unless feed() stopped
+        early
+        '''
+        if not self._found_all:
+            self._parser.close()
+
+
+class ManifestCache(object):
+    """On-disk store of parsed manifests, keyed by item identifier.
+
+    A manifest is used for ttl seconds after it was downloaded; the
+    manifests asked for in this session are kept in memory too.
+    """
+
+    def __init__(self, path, ttl=_TTL, max_manifests=_MAX_MANIFESTS):
+        self._path = path
+        self._ttl = ttl
+        self._max_manifests = max_manifests
+        self._lock = threading.Lock()
+        self._manifests = {}
+        if not os.path.exists(self._path):
+            os.makedirs(self._path)
+
+    def _get_file_name(self, identifier):
+        return os.path.join(self._path,
+                hashlib.sha1(identifier.encode('utf-8')).hexdigest())
+
+    def get(self, identifier):
+        '''
+        Returns {content type: (file name, size)} for identifier, or None
+        if it is not cached or too old
+        '''
+        with self._lock:
+            cached = self._manifests.get(identifier)
+        if cached is None:
+            try:
+                with open(self._get_file_name(identifier)) as f:
+                    cached = json.load(f)
+            except (IOError, OSError, ValueError):
+                return None
+            if cached.get('identifier') != identifier:
+                return None
+            cached['files'] = dict([(content_type, tuple(file_info))
+                                    for content_type, file_info
+                                    in cached['files'].items()])
+            with self._lock:
+                self._manifests[identifier] = cached
+        if time.time() - cached['time'] > self._ttl:
+            return None
+        return cached['files']
+
+    def store(self, identifier, files):
+        cached = {'identifier': identifier, 'time': time.time(),
+                  'files': files}
+        file_name = self._get_file_name(identifier)
+        with self._lock:
+            self._manifests[identifier] = cached
+            try:
+                with open(file_name + '.tmp', 'w') as f:
+                    json.dump(cached, f)
+                os.rename(file_name + '.tmp', file_name)
+            except (IOError, OSError) as e:
+                logging.warning('Could not cache the files of %s: %s',
+                                identifier, e)
+                return
+            self._prune()
+
+    def _prune(self):
+        names = [os.path.join(self._path, name)
+                 for name in os.listdir(self._path)
+                 if not name.endswith('.tmp')]
+        if len(names) <= self._max_manifests:
+            return
+        names.sort(key=os.path.getmtime)
+        for file_name in names[:len(names) - self._max_manifests]:
+            try:
+                os.remove(file_name)
+            except OSError:
+                pass
@@ -16,8 +16,12 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
-from xml.etree import ElementTree
+import json
 import logging
+import os
+import threading
+
+import workers
 
 _ISO_639_XML_PATH = '/usr/share/xml/iso-codes/iso_639.xml'
 
@@ -30,24 +34,121 @@ def singleton(object, instantiated=[]):
     instantiated.append(object.__class__)
 
 
+def _get_stamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime, stat.st_size]
+
+
+def _parse_xml(path):
+    # only needed when the saved table is missing or stale
+    from xml.etree import ElementTree
+    names = {}
+    try:
+        root = ElementTree.parse(path).getroot()
+    except (IOError, OSError, ElementTree.ParseError) as e:
+        logging.warning('Can not read the language names: %s', e)
+        return names
+    for child in root:
+        lang_name = child.attrib.get('name', None)
+        lang_code = child.attrib.get('iso_639_1_code', None)
+        if lang_code is not None and lang_name is not None:
+            names[lang_code] = lang_name
+    return names
+
+
 class LanguageNames(object):
+    """Names of the two letter language codes.
+
+    Parsing the iso-codes XML is slow, so the table read from it is saved
+    in cache_path with the mtime and size of the XML, and read from there
+    until the XML changes.
+    """
 
-    def __init__(self):
+    def __init__(self, cache_path=None, xml_path=_ISO_639_XML_PATH):
         singleton(self)
+        self._cache_path = cache_path
+        self._xml_path = xml_path
+        self._lock = threading.Lock()
         self._cache = None
 
-    def get_full_language_name(self, code):
-        if self._cache == None:
-            self._cache = {}
-            _xmldoc = ElementTree.parse(_ISO_639_XML_PATH)
-            _eroot = _xmldoc.getroot()
-            for child in _eroot.getchildren():
-                if child.attrib is not None:
-                    lang_name = child.attrib.get('name', None)
-                    lang_code = child.attrib.get('iso_639_1_code', None)
-
-                    if lang_code is not None and lang_name is not None:
-                        self._cache[lang_code] = lang_name
-            _xmldoc = None
+    def load_cached(self):
+        '''
+        Reads the saved table if it is current, never parses the XML.
+        Returns True if the names are loaded.
+        '''
+        with self._lock:
+            if self._cache is None:
+                self._cache = self._read_table(_get_stamp(self._xml_path))
+        return self._cache is not None
+
+    def load(self):
+        '''
+        Reads the saved table, or parses the XML and saves it
+        '''
+        with self._lock:
+            if self._cache is not None:
+                return
+            stamp = _get_stamp(self._xml_path)
+            names = self._read_table(stamp)
+            if names is None:
+                logging.debug('Reading the language names from %s',
+                              self._xml_path)
+                names = _parse_xml(self._xml_path)
+                if stamp is not None:
+                    self._write_table(stamp, names)
+            self._cache = names
 
+    def _read_table(self, stamp):
+        if self._cache_path is None or stamp is None:
+            return None
+        try:
+            with open(self._cache_path) as f:
+                table = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if table.get('stamp') != stamp:
+            return None
+        return table.get('names')
+
+    def _write_table(self, stamp, names):
+        if self._cache_path is None:
+            return
+        try:
+            with open(self._cache_path + '.tmp', 'w') as f:
+                json.dump({'stamp': stamp, 'names': names}, f)
+            os.rename(self._cache_path + '.tmp', self._cache_path)
+        except (IOError, OSError) as e:
+            logging.warning('Could not save the language names: %s', e)
+
+    def get_full_language_name(self, code):
+        if self._cache is None:
+            self.load()
         return self._cache[code]
+
+    def get_loaded_language_name(self, code):
+        '''
+        Returns the name of code, or None while the table is not loaded;
+        never reads the disk
+        '''
+        cache = self._cache
+        if cache is None:
+            return None
+        return cache[code]
+
+
+class LoadTask(workers.Task):
+    """Loads a LanguageNames table in a worker, ready_cb() is called from
+    the worker thread."""
+
+    def __init__(self, language_names, ready_cb):
+        workers.Task.__init__(self)
+        self._language_names = language_names
+        self._ready_cb = ready_cb
+
+    def run(self):
+        self._language_names.load()
+        if not self.is_stopped():
+            self._ready_cb()
@@ -50,13 +50,11 @@ class ListView(ExtListView):
                               ([])),
         }
 
-    def __init__(self, lang_code_handler):
+    def __init__(self):
         ExtListView.__init__(self, self.columns, sortable=True,
                 useMarkup=False, canShowHideColumns=True)
         #self.enableDNDReordering() # Is this needed ?
 
-        self._lang_code_handler = lang_code_handler
-
         selection = self.get_selection()
         selection.set_mode(Gtk.SelectionMode.SINGLE)
         selection.connect('changed', self.__selection_changed_cb)
@@ -67,26 +65,32 @@ class ListView(ExtListView):
     def populate(self, results):
         self.populate_with_books(results.get_book_list())
 
-    def populate_with_books(self, books):
-        rows = []
-
-        for book in books:
-            lang = ''
-            try:
-                lang = self._lang_code_handler.get_full_language_name(
-                                                        book.get_language())
-            except KeyError:
-                pass
+    def _get_row(self, book):
+        # a book dropped from memory only keeps its title
+        if book.is_stub():
+            return [book.get_title(), '', '', '', '', book]
+        return [book.get_title(), book.get_author(), book.get_publisher(),
+                book.get_language_name(), book.get_published_year(), book]
 
-            rows.append([book.get_title(), book.get_author(),
-                         book.get_publisher(), lang,
-                         book.get_published_year(), book])
+    def populate_with_books(self, books):
+        rows = [self._get_row(book) for book in books]
 
         # README: I had to remove the self.clear() here because it
         # made the listview to scroll to the top on Gtk3
 
         self.insertRows(rows)
 
+    def replace_books(self, replaced):
+        '''
+        Updates the rows of the books in the (old, new) pairs of replaced
+        '''
+        new_books = dict([(id(old), new) for old, new in replaced])
+        for row in self.store:
+            book = new_books.get(id(row[self.ROW_BOOK]))
+            if book is not None:
+                for column, value in enumerate(self._get_row(book)):
+                    row[column] = value
+
     def get_selected_book(self):
         try:
             ret = self.getFirstSelectedRow()[self.ROW_BOOK]
@@ -0,0 +1,426 @@
+#! /usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""HTTP requests multiplexed on one asyncio event loop.
+
+The loop runs in a single background thread that is started with the
+first request.  Requests are made from the GLib main loop and their
+callbacks are run there too, so a hundred cover downloads cost a
+hundred coroutines instead of a hundred threads.
+
+Only what the lightweight downloads need is implemented: GET over
+HTTP/1.1 with keep-alive, chunked bodies and redirects.  Like urllib, the
+requests go through the proxies of the *_proxy environment variables,
+https ones in a CONNECT tunnel, except for the hosts in no_proxy.
+"""
+
+import asyncio
+import base64
+import http.client
+import io
+import logging
+import os
+import socket
+import ssl
+import threading
+import urllib.parse
+import urllib.request
+
+from gi.repository import GLib
+
+_CONNECTIONS_PER_HOST = 6
+_TIMEOUT = 30
+_MAX_REDIRECTS = 5
+_CHUNK_SIZE = 16384
+_REDIRECTS = (301, 302, 303, 307, 308)
+
+
+class Response(object):
+    """What a request got: the body is in data, or in the file path."""
+
+    __slots__ = ('url', 'status', 'headers', 'data', 'path')
+
+    def __init__(self, url, status, headers):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.data = None
+        self.path = None
+
+
+class Request(object):
+    """A request running on a NetEngine.
+
+    Once cancel() is called the request is aborted and its callback is
+    never called.
+    """
+
+    def __init__(self, url, ready_cb, user_data):
+        self.url = url
+        self._ready_cb = ready_cb
+        self._user_data = user_data
+        self._future = None
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+        if self._future is not None:
+            self._future.cancel()
+
+    def is_cancelled(self):
+        return self._cancelled
+
+    def _done(self, future):
+        # called on the event loop thread
+        if not future.cancelled():
+            GLib.idle_add(self.__ready, future)
+
+    def __ready(self, future):
+        if self._cancelled:
+            return
+        error = future.exception()
+        response = None
+        if error is None:
+            response = future.result()
+        else:
+            logging.debug('Request of %s failed: %s', self.url, error)
+        self._ready_cb(response, error, self._user_data)
+
+
+class NetEngine(object):
+    """Runs HTTP GET requests on an asyncio loop in a background thread.
+
+    At most connections_per_host requests to the same host run at the
+    same time, the others wait for a connection; every request fails
+    after timeout seconds.  proxies maps url schemes to proxy urls, by
+    default they are read from the environment like urllib does.
+    """
+
+    def __init__(self, connections_per_host=_CONNECTIONS_PER_HOST,
+                 timeout=_TIMEOUT, proxies=None):
+        self._connections_per_host = connections_per_host
+        self._timeout = timeout
+        if proxies is None:
+            proxies = urllib.request.getproxies()
+        self._proxies = proxies
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        # used only on the loop thread
+        self._semaphores = {}
+        self._idle = {}
+        self._running = 0
+
+    def _get_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._run,
+                                                args=(self._loop,),
+                                                name='netengine')
+                self._thread.daemon = True
+                self._thread.start()
+            return self._loop
+
+    def _run(self, loop):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+
+    def fetch(self, url, ready_cb, path=None, consumer=None, headers=None,
+              timeout=None, user_data=None):
+        '''
+        GETs url, returns a Request.  The body is saved to path, given to
+        consumer(data) chunk by chunk, or kept in memory.  A consumer
+        that returns True ends the request early.  ready_cb(response,
+        error, user_data) is called from the main loop, response is None
+        if the request failed.
+        '''
+        request = Request(url, ready_cb, user_data)
+        coroutine = self._get(url, path, consumer, headers or {},
+                              timeout or self._timeout)
+        request._future = asyncio.run_coroutine_threadsafe(coroutine,
+                                                           self._get_loop())
+        request._future.add_done_callback(request._done)
+        return request
+
+    def get_stats(self):
+        '''
+        Returns {'requests', 'idle connections'} counters
+        '''
+        return {'requests': self._running,
+                'idle connections': sum([len(idle)
+                                         for idle in self._idle.values()])}
+
+    def close(self):
+        '''
+        Stops the loop, the requests still running are dropped
+        '''
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is not None:
+            loop.call_soon_threadsafe(loop.stop)
+
+    async def _get(self, url, path, consumer, headers, timeout):
+        self._running += 1
+        try:
+            for redirect in range(_MAX_REDIRECTS + 1):
+                response = await self._request(url, path, consumer, headers,
+                                               timeout)
+                location = response.headers.get('Location')
+                if response.status not in _REDIRECTS or location is None:
+                    break
+                url = urllib.parse.urljoin(url, location)
+            else:
+                raise IOError('Too many redirects')
+            if response.status >= 400:
+                raise IOError('HTTP Error %d' % response.status)
+            return response
+        except BaseException:
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+            raise
+        finally:
+            self._running -= 1
+
+    def _get_semaphore(self, key):
+        semaphore = self._semaphores.get(key)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self._connections_per_host)
+            self._semaphores[key] = semaphore
+        return semaphore
+
+    def _get_proxy(self, parts):
+        '''
+        Returns (host, port, Proxy-Authorization or None) of the proxy
+        for the url split in parts, or None to connect to the host
+        '''
+        proxy = self._proxies.get(parts.scheme)
+        if not proxy or urllib.request.proxy_bypass(parts.hostname):
+            return None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        proxy_parts = urllib.parse.urlsplit(proxy)
+        if proxy_parts.scheme != 'http':
+            raise IOError('Unsupported proxy %s' % proxy)
+        authorization = None
+        if proxy_parts.username is not None:
+            credentials = '%s:%s' % (
+                    urllib.parse.unquote(proxy_parts.username),
+                    urllib.parse.unquote(proxy_parts.password or ''))
+            authorization = 'Basic ' + base64.b64encode(
+                    credentials.encode('utf-8')).decode('ascii')
+        return (proxy_parts.hostname, proxy_parts.port or 80, authorization)
+
+    async def _connect(self, key):
+        idle = self._idle.get(key)
+        while idle:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        scheme, host, port, tunnel = key
+        if tunnel is not None:
+            reader, writer = await self._open_tunnel(host, port, tunnel)
+            return reader, writer, False
+        context = None
+        if scheme == 'https':
+            context = ssl.create_default_context()
+        reader, writer = await asyncio.open_connection(host, port,
+                                                       ssl=context)
+        return reader, writer, False
+
+    async def _open_tunnel(self, host, port, proxy):
+        # the CONNECT is made on a bare socket, TLS is then started over
+        # it by open_connection
+        proxy_host, proxy_port, authorization = proxy
+        loop = asyncio.get_event_loop()
+        addresses = await loop.getaddrinfo(proxy_host, proxy_port,
+                                           type=socket.SOCK_STREAM)
+        error = None
+        for family, type_, proto, _, address in addresses:
+            sock = socket.socket(family, type_, proto)
+            sock.setblocking(False)
+            try:
+                await loop.sock_connect(sock, address)
+                break
+            except OSError as e:
+                sock.close()
+                error = e
+        else:
+            raise error or IOError('Can not resolve %s' % proxy_host)
+        try:
+            lines = ['CONNECT %s:%d HTTP/1.1' % (host, port),
+                     'Host: %s:%d' % (host, port)]
+            if authorization is not None:
+                lines.append('Proxy-Authorization: %s' % authorization)
+            await loop.sock_sendall(sock, ('\r\n'.join(lines) +
+                                           '\r\n\r\n').encode('latin-1'))
+            head = b''
+            while b'\r\n\r\n' not in head:
+                data = await loop.sock_recv(sock, _CHUNK_SIZE)
+                if not data:
+                    raise ConnectionResetError('Connection closed by the '
+                                               'proxy')
+                head += data
+            fields = head.split(b'\r\n', 1)[0].decode('latin-1').split()
+            if len(fields) < 2 or fields[1] != '200':
+                raise IOError('The proxy refused the tunnel to %s:%d: %s' %
+                              (host, port, ' '.join(fields[1:])))
+            return await asyncio.open_connection(
+                    sock=sock, ssl=ssl.create_default_context(),
+                    server_hostname=host)
+        except BaseException:
+            sock.close()
+            raise
+
+    def _release(self, key, reader, writer):
+        idle = self._idle.setdefault(key, [])
+        if len(idle) < self._connections_per_host:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+    async def _request(self, url, path, consumer, headers, timeout):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise IOError('Unsupported url %s' % url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        host_key = (parts.scheme, parts.hostname, port)
+        selector = parts.path or '/'
+        if parts.query:
+            selector += '?' + parts.query
+        proxy = self._get_proxy(parts)
+        if proxy is None:
+            key = host_key + (None,)
+        elif parts.scheme == 'https':
+            key = host_key + (proxy,)
+        else:
+            # plain http goes to the proxy, which is asked the full url
+            key = ('http', proxy[0], proxy[1], None)
+            selector = '%s://%s%s' % (parts.scheme, parts.netloc, selector)
+        lines = ['GET %s HTTP/1.1' % selector, 'Host: %s' % parts.netloc]
+        if proxy is not None and parts.scheme == 'http' and \
+                proxy[2] is not None:
+            lines.append('Proxy-Authorization: %s' % proxy[2])
+        lines.extend(['%s: %s' % item for item in headers.items()])
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+        # the time waiting for a free connection does not count
+        async with self._get_semaphore(host_key):
+            return await asyncio.wait_for(self._exchange(key, head, url,
+                    path, consumer), timeout)
+
+    async def _exchange(self, key, head, url, path, consumer):
+        reader, writer, reused = await self._connect(key)
+        try:
+            try:
+                writer.write(head)
+                await writer.drain()
+                status, response_headers = await self._read_head(reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                if not reused:
+                    raise
+                # the server dropped a kept-alive connection
+                writer.close()
+                reader, writer, reused = await self._connect(key)
+                writer.write(head)
+                await writer.drain()
+                status, response_headers = await self._read_head(reader)
+
+            response = Response(url, status, response_headers)
+            if status in _REDIRECTS:
+                complete = await self._read_body(reader,
+                                                 response_headers,
+                                                 lambda data: None)
+            elif path is not None:
+                with open(path, 'wb') as f:
+                    complete = await self._read_body(reader,
+                            response_headers, f.write)
+                response.path = path
+            elif consumer is not None:
+                complete = await self._read_body(reader,
+                                                 response_headers,
+                                                 consumer)
+            else:
+                body = io.BytesIO()
+                complete = await self._read_body(reader,
+                                                 response_headers,
+                                                 body.write)
+                response.data = body.getvalue()
+        except BaseException:
+            writer.close()
+            raise
+        if complete and \
+                response_headers.get('Connection', '').lower() != 'close':
+            self._release(key, reader, writer)
+        else:
+            writer.close()
+        return response
+
+    async def _read_head(self, reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError('Connection closed by the server')
+        fields = status_line.decode('latin-1').split(None, 2)
+        if len(fields) < 2 or not fields[0].startswith('HTTP/'):
+            raise IOError('Bad status line %r' % status_line)
+        lines = []
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            lines.append(line)
+        headers = http.client.parse_headers(io.BytesIO(b''.join(lines) +
+                                                       b'\r\n'))
+        return int(fields[1]), headers
+
+    async def _read_body(self, reader, headers, write):
+        '''
+        Passes the body to write, returns True if it was read to the end
+        so the connection can be used again; write returning True stops
+        the reading; the return value of file.write does not
+        '''
+        if headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b'\r\n', b'\n',
+                                                             b''):
+                        pass
+                    return True
+                data = await reader.readexactly(size)
+                await reader.readexactly(2)
+                if write(data) is True:
+                    return False
+        length = headers.get('Content-Length')
+        if length is not None:
+            left = int(length)
+            while left > 0:
+                data = await reader.read(min(_CHUNK_SIZE, left))
+                if not data:
+                    raise IOError('Connection closed with %d bytes left' %
+                                  left)
+                left -= len(data)
+                if write(data) is True:
+                    return False
+            return True
+        # the body ends when the server closes the connection
+        while True:
+            data = await reader.read(_CHUNK_SIZE)
+            if not data:
+                return False
+            if write(data) is True:
+                return False
@@ -19,195 +19,429 @@
 from gi.repository import GLib
 from gi.repository import GObject
 from gi.repository import Gtk
-from gettext import gettext as _
-from sugar3 import network
 
+import collections
 import logging
-import threading
 import os
-import urllib.request, urllib.parse, urllib.error
+import urllib.parse, urllib.error
 import time
-import csv
+import io
+import threading
 
 import sys
 sys.path.insert(0, './')
-import feedparser
+import iamanifests
+import opdsparser
+import workers
 
 _REL_OPDS_ACQUISTION = 'http://opds-spec.org/acquisition'
-_REL_SUBSECTION = 'subsection'
-_REL_OPDS_POPULAR = 'http://opds-spec.org/sort/popular'
-_REL_OPDS_NEW = 'http://opds-spec.org/sort/new'
 _REL_ALTERNATE = 'alternate'
-_REL_CRAWLABLE = 'http://opds-spec.org/crawlable'
 
-GObject.threads_init()
+_NAVIGATION_RELS = opdsparser.NAVIGATION_RELS
+
+KIND_BOOK = opdsparser.KIND_BOOK
+KIND_CATALOG = opdsparser.KIND_CATALOG
+
+_CHUNK_SIZE = 16384
+# times a resumable download is resumed after a network error
+_RETRIES = 3
+# files are only split in ranges at least this big
+_MIN_SEGMENT_SIZE = 4 * 1024 * 1024
+# the ranges of a split file still missing are saved every this many bytes
+_SEGMENTS_SAVE_SIZE = 1024 * 1024
+# internet archive results are shown in batches of this many books
+_IA_BATCH_SIZE = 25
+# and asked in pages of this many
+_IA_PAGE_SIZE = 50
+# the books found in a volume are shown in batches of this many
+_VOLUME_BATCH_SIZE = 200
+# pages of books a query result keeps in memory, the books of the other
+# pages are replaced by stubs
+_MAX_PAGES = 5
 
+GObject.threads_init()
 
-class ReadURLDownloader(network.GlibURLDownloader):
-    """URLDownloader that provides content-length and content-type."""
 
-    def get_content_length(self):
-        """Return the content-length of the download."""
-        if self._info is not None:
-            length = self._info.headers.get('Content-Length')
-            if length is not None:
-                return int(length)
+_feed_cache = None
+_partial_store = None
+_manifest_cache = None
+_language_names = None
+# identifier -> {'request', 'callers'} of the manifests being fetched
+_manifest_requests = {}
+# catalog path -> catalogindex.CatalogIndex of the local volumes
+_volume_indexes = {}
+_volume_indexes_lock = threading.Lock()
+# the network modules are slow to import, they are loaded on the first
+# download
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+_connections_per_host = None
+_worker_pool = workers.WorkerPool()
+_net_engine = None
+_requests_per_host = None
+
+
+def set_feed_cache(feed_cache):
+    '''
+    Sets the feedcache.FeedCache used to make conditional requests
+    '''
+    global _feed_cache
+    _feed_cache = feed_cache
+
+
+def set_partial_store(partial_store):
+    '''
+    Sets the partialdownloads.PartialStore that keeps interrupted
+    resumable downloads
+    '''
+    global _partial_store
+    _partial_store = partial_store
+
+
+def set_manifest_cache(manifest_cache):
+    '''
+    Sets the iamanifests.ManifestCache of the Internet Archive books
+    '''
+    global _manifest_cache
+    _manifest_cache = manifest_cache
+
+
+def set_language_names(language_names):
+    '''
+    Sets the languagenames.LanguageNames used to name the language of
+    the books when they are created
+    '''
+    global _language_names
+    _language_names = language_names
+
+
+def _get_language_name(code):
+    if _language_names is None:
+        return ''
+    try:
+        if threading.current_thread() is not threading.main_thread():
+            return _language_names.get_full_language_name(code)
+        # the main loop does not wait for the XML to be parsed, the code
+        # is shown until the table is loaded
+        name = _language_names.get_loaded_language_name(code)
+        if name is None:
+            return code
+        return name
+    except KeyError:
+        return ''
+
+
+def set_max_pages(max_pages):
+    '''
+    Sets how many result pages of a query are kept in memory
+    '''
+    global _MAX_PAGES
+    _MAX_PAGES = max_pages
+
+
+def set_connection_pool(connection_pool):
+    '''
+    Sets the httppool.ConnectionPool shared by feeds and file downloads
+    '''
+    global _connection_pool
+    with _connection_pool_lock:
+        if _connection_pool is not None:
+            _connection_pool.close()
+        _connection_pool = connection_pool
+
+
+def set_connections_per_host(connections_per_host):
+    '''
+    Sets the size of the httppool.ConnectionPool made on the first
+    download
+    '''
+    global _connections_per_host
+    _connections_per_host = connections_per_host
+
+
+def _get_connection_pool():
+    global _connection_pool
+    with _connection_pool_lock:
+        if _connection_pool is None:
+            import httppool
+            if _connections_per_host is None:
+                _connection_pool = httppool.ConnectionPool()
             else:
-                return 0
+                _connection_pool = httppool.ConnectionPool(
+                        _connections_per_host)
+        return _connection_pool
+
+
+def set_worker_pool(worker_pool):
+    '''
+    Sets the workers.WorkerPool that runs all the downloads
+    '''
+    global _worker_pool
+    _worker_pool.shutdown()
+    _worker_pool = worker_pool
+
+
+def set_net_engine(net_engine):
+    '''
+    Sets the netengine.NetEngine that runs the lightweight requests
+    '''
+    global _net_engine
+    if _net_engine is not None:
+        _net_engine.close()
+    _net_engine = net_engine
+
+
+def set_requests_per_host(requests_per_host):
+    '''
+    Sets how many requests the netengine.NetEngine made on the first
+    use runs at once on a host
+    '''
+    global _requests_per_host
+    _requests_per_host = requests_per_host
+
+
+def get_net_engine():
+    global _net_engine
+    if _net_engine is None:
+        import netengine
+        if _requests_per_host is None:
+            _net_engine = netengine.NetEngine()
+        else:
+            _net_engine = netengine.NetEngine(_requests_per_host)
+    return _net_engine
 
-    def get_content_type(self):
-        """Return the content-type of the download."""
-        if self._info is not None:
-            return self._info.headers.get('Content-type')
-        return None
+
+def get_worker_pool():
+    '''
+    Returns the workers.WorkerPool, get_stats() reports its load
+    '''
+    return _worker_pool
 
 
-class DownloadThread(threading.Thread):
+class DownloadThread(workers.Task):
 
-    def __init__(self, uri, headers, feedobj_cb):
-        threading.Thread.__init__(self)
+    def __init__(self, uri, headers, entries_cb, feedobj_cb):
+        workers.Task.__init__(self)
         self._uri = uri
         self._headers = headers
+        self._entries_cb = entries_cb
         self._feedobj_cb = feedobj_cb
 
-        self.stopthread = threading.Event()
-
     def run(self):
         logging.debug('Searching URL %s headers %s' % (self._uri,
                                                        self._headers))
-        feedobj = feedparser.parse(self._uri) # , request_headers=self._headers)
-        self._feedobj_cb(feedobj)
+        cache = _feed_cache
+        language = self._headers.get('Accept-Language')
+        cached = None
+        if cache is not None and self._uri.startswith('http'):
+            cached = cache.get(self._uri, language)
+        etag = modified = None
+        if cached is not None:
+            etag, modified = cached['etag'], cached['modified']
 
-    def stop(self):
-        self.stopthread.set()
+        try:
+            # entries are handed over as soon as the parser has seen them,
+            # self._headers are not sent (request_headers is disabled)
+            feedobj = opdsparser.parse_incremental(self._uri,
+                    self._entries_cb, etag=etag, modified=modified,
+                    handlers=_get_connection_pool().get_handlers(self.token),
+                    cancel_token=self.token)
+            if self.is_stopped():
+                logging.debug('Search of %s cancelled', self._uri)
+                return
+
+            if cached is not None and feedobj.get('status') == 304:
+                logging.debug('Feed %s not modified, using cache', self._uri)
+                feedobj = {'feed': cached['feed'],
+                           'entries': cached['entries'], 'status': 304}
+                self._entries_cb(feedobj['feed'], feedobj['entries'])
+            elif cache is not None and self._uri.startswith('http') and \
+                    not feedobj.get('bozo') and feedobj.get('status') == 200:
+                cache.store(self._uri, language, feedobj)
+        except Exception as e:
+            if self.is_stopped():
+                return
+            # the query still finishes, with the error
+            logging.exception('Search of %s failed', self._uri)
+            feedobj = {'feed': {}, 'entries': [], 'bozo': 1,
+                       'bozo_exception': e}
+        self._feedobj_cb(feedobj)
 
 
 class Book(object):
+    """A catalog entry.
+
+    The fields used by the activity are extracted, and the links classified
+    into formats and cover images, once when the book is created; the
+    parsed entry is not kept.
+    """
+
+    __slots__ = ('_configuration', '_basepath', '_title', '_author',
+                 '_publisher', '_published', '_language', '_language_name',
+                 '_summary', '_object_id', '_id', '_kind', '_types',
+                 '_image_urls')
 
     def __init__(self, configuration, entry, basepath=None):
-        self._entry = entry
         self._basepath = basepath
         self._configuration = configuration
+        self._title = entry.get('title', 'Unknown')
+        self._author = entry.get('author', 'Unknown')
+        self._publisher = entry.get('dcterms_publisher', 'Unknown')
+        self._published = entry.get('published', 'Unknown')
+        self._language = entry.get('dcterms_language', 'Unknown')
+        # books are mostly made in the workers, the ones made in the main
+        # loop never wait for the language table
+        self._language_name = _get_language_name(self._language)
+        self._object_id = entry.get('object_id', 'Unknown')
+        self._id = entry.get('id')
+        if self._configuration is not None \
+            and 'summary_field' in self._configuration:
+                self._summary = entry.get(
+                        self._configuration['summary_field'], 'Unknown')
+        else:
+                self._summary = 'Unknown'
+        self._kind = None
+        self._types = {}
+        self._image_urls = {}
+        self._classify_links(entry)
+
+    def _resolve_href(self, href):
+        if self._basepath is not None and \
+                not (href.startswith('http') or href.startswith('ftp')):
+            return 'file://' + os.path.join(self._basepath, href)
+        return href
+
+    def _classify_links(self, entry):
+        cover_rel = None
+        if self._configuration is not None:
+            cover_rel = self._configuration.get('opds_cover')
+        self._kind = opdsparser.get_entry_kind(entry)
+        for link in entry.get('links', []):
+            rel = link['rel']
+            if rel.startswith(_REL_OPDS_ACQUISTION):
+                self._types[link['type']] = self._resolve_href(link['href'])
+            elif rel in _NAVIGATION_RELS or rel == _REL_ALTERNATE:
+                self._types[link['type']] = link['href']
+            elif rel == cover_rel:
+                self._image_urls[link['type']] = \
+                        self._resolve_href(link['href'])
+
+    def get_kind(self):
+        '''
+        Returns KIND_BOOK, KIND_CATALOG or None for an entry without links
+        '''
+        return self._kind
 
-    def get_title(self):
-        try:
-            ret = self._entry['title']
-        except KeyError:
-            ret = 'Unknown'
+    def is_catalog(self):
+        return self._kind == KIND_CATALOG
 
-        return ret
+    def get_title(self):
+        return self._title
 
     def get_author(self):
-        try:
-            ret = self._entry['author']
-        except KeyError:
-            ret = 'Unknown'
-
-        return ret
+        return self._author
 
     def get_types(self):
-        ret = {}
-        for link in self._entry['links']:
-            if link['rel'].startswith(_REL_OPDS_ACQUISTION):
-                if self._basepath is not None and \
-                        not (link['href'].startswith('http') or \
-                                link['href'].startswith('ftp')):
-                    ret[link['type']] = 'file://' \
-                        + os.path.join(self._basepath, link['href'])
-                else:
-                    ret[link['type']] = link['href']
-            elif link['rel'] in \
-            [_REL_OPDS_POPULAR, _REL_OPDS_NEW, _REL_SUBSECTION]:
-                ret[link['type']] = link['href']
-            elif link['rel'] == _REL_ALTERNATE:
-                ret[link['type']] = link['href']
-            else:
-                pass
-        return ret
+        return self._types
 
-    def get_download_links(self, content_type, download_cb, _):
+    def get_download_links(self, content_type, download_cb, error_cb):
+        '''
+        Calls download_cb(url) with the url of the content_type file, or
+        error_cb(types) with the types that are known if there is none;
+        error_cb(None) when they could not be found out
+        '''
         types = self.get_types()
         if content_type in types:
             url = types[content_type]
             GLib.idle_add(download_cb, url)
+        else:
+            GLib.idle_add(error_cb, types)
 
     def get_publisher(self):
-        try:
-            ret = self._entry['dcterms_publisher']
-        except KeyError:
-            ret = 'Unknown'
-
-        return ret
+        return self._publisher
 
     def get_published_year(self):
-        try:
-            ret = self._entry['published']
-        except KeyError:
-            ret = 'Unknown'
-
-        return ret
+        return self._published
 
     def get_language(self):
-        try:
-            ret = self._entry['dcterms_language']
-        except KeyError:
-            ret = 'Unknown'
+        return self._language
 
-        return ret
+    def get_language_name(self):
+        '''
+        Returns the full name of the language, or '' if it is not known
+        '''
+        return self._language_name
 
     def get_image_url(self):
-        try:
-            ret = {}
-            for link in self._entry['links']:
-                if link['rel'] == self._configuration['opds_cover']:
-                    if self._basepath is not None and \
-                            not (link['href'].startswith('http') or \
-                                    link['href'].startswith('ftp')):
-                        ret[link['type']] = 'file://' \
-                            + os.path.join(self._basepath, link['href'])
-                    else:
-                        ret[link['type']] = link['href']
-        except KeyError:
-            ret = 'Unknown'
-        return ret
+        return self._image_urls
 
     def get_summary(self):
-        if self._configuration is not None \
-            and 'summary_field' in self._configuration:
-                try:
-                    ret = self._entry[self._configuration['summary_field']]
-                except KeyError:
-                    ret = 'Unknown'
-        else:
-                ret = 'Unknown'
-        return ret
+        return self._summary
 
     def get_object_id(self):
-        try:
-            ret = self._entry['object_id']
-        except KeyError:
-            ret = 'Unknown'
-
-        return ret
-
-    def match(self, terms):
-        #TODO: Make this more comprehensive
-        for term in terms.split('+'):
-            if term in self.get_title():
-                return True
-            if term in self.get_author():
-                return True
-            if term in self.get_publisher():
-                return True
+        return self._object_id
+
+    def get_id(self):
+        '''
+        Returns the id of the entry in the catalog, or None
+        '''
+        return self._id
+
+    def get_key(self):
+        '''
+        Returns what tells this book apart in a query result
+        '''
+        return self._id or (self._title, self._author)
+
+    def is_stub(self):
         return False
 
 
+class BookStub(object):
+    """What is kept of a book of a result page dropped from memory.
+
+    The page is downloaded again when its books are needed, see
+    QueryResult.set_visible_books().
+    """
+
+    __slots__ = ('_key', '_title', '_page')
+
+    def __init__(self, key, title, page):
+        self._key = key
+        self._title = title
+        self._page = page
+
+    def get_key(self):
+        return self._key
+
+    def get_title(self):
+        return self._title
+
+    def get_page(self):
+        return self._page
+
+    def is_stub(self):
+        return True
+
+
 class QueryResult(GObject.GObject):
+    """The books found by a query, in pages.
+
+    Only the _MAX_PAGES pages used last are kept in memory; the books of
+    the other pages are replaced by BookStub objects, and the real books
+    are brought back with 'books-replaced' when they are visible again.
+    """
 
     __gsignals__ = {
         'updated': (GObject.SignalFlags.RUN_FIRST,
                           None,
                           ([bool])),
+        'entries-added': (GObject.SignalFlags.RUN_FIRST,
+                          None,
+                          ([GObject.TYPE_PYOBJECT])),
+        'books-replaced': (GObject.SignalFlags.RUN_FIRST,
+                          None,
+                          ([GObject.TYPE_PYOBJECT])),
     }
 
     def __init__(self, configuration, query, language):
@@ -216,51 +450,150 @@ class QueryResult(GObject.GObject):
         self._uri = self._configuration['query_uri']
         self._query = query
         self._language = language
+        self._headers = {}
         self._feedobj = None
         self._next_uri = ''
         self._ready = False
         self._booklist = []
         self._cataloglist = []
+        self._cancelled = False
+        # the page being downloaded, the one after the last page shown is
+        # fetched in the background
+        self._page = None
+        self._page_uris = set()
+        # number -> {'uri', 'start', 'end'} of the pages in _booklist
+        self._pages = {}
+        # numbers of the pages with real books, least recently used first
+        self._loaded_pages = collections.OrderedDict()
+        # book key -> page number, pages can overlap
+        self._book_pages = {}
         self.threads = []
-        
+        self._start_query()
+
+    def _start_query(self):
         uri = self._uri
-        headers = {}
         if not self.is_local():
             uri += self._query.replace(' ', '+')
             if self._language is not None and self._language != 'all':
-                headers['Accept-Language'] = self._language
+                self._headers['Accept-Language'] = self._language
                 uri += '&lang=' + self._language
-        d_thread = DownloadThread(uri, headers, self.__feedobj_cb)
-        d_thread.daemon = True
-        self.threads.append(d_thread)
-        d_thread.start()
-
-    def __feedobj_cb(self, feedobj):
-        self._feedobj = feedobj
-        # Get catalog Type
-        CATALOG_TYPE = 'COMMON'
-        if 'links' in feedobj['feed']:
-            for link in feedobj['feed']['links']:
-                if link['rel'] == _REL_CRAWLABLE:
-                    CATALOG_TYPE = 'CRAWLABLE'
-                    break
-
-        def entry_type(entry):
-            for link in entry['links']:
-                if link['rel'] in \
-                    [_REL_OPDS_POPULAR, _REL_OPDS_NEW, _REL_SUBSECTION]:
-                    return "CATALOG"
-                else:
-                    return 'BOOK'
+        self._start_page(uri, workers.QUEUE_FEEDS, True)
+
+    def _start_page(self, uri, queue_name, shown):
+        number = 1
+        if self._page is not None:
+            number = self._page['number'] + 1
+            if self._page.get('stopped'):
+                number = self._page['number']
+        page = {'uri': uri, 'number': number, 'books': [], 'catalogs': [],
+                'shown': shown, 'feedobj': None}
+        self._page = page
+        self._page_uris.add(uri)
+        task = self._create_page_task(page)
+        self.threads.append(task)
+        _worker_pool.submit(queue_name, task)
+
+    def _create_page_task(self, page):
+        return DownloadThread(page['uri'], self._headers,
+                lambda feed, entries: self.__entries_cb(page, feed, entries),
+                lambda feedobj: GLib.idle_add(self._finish_page, page,
+                                              feedobj))
+
+    def __entries_cb(self, page, feed, entries):
+        # Called from the download thread for every parsed batch
+        if self._cancelled:
+            return
+        crawlable = opdsparser.is_crawlable(feed)
+        books = []
+        catalogs = []
+        for entry in entries:
+            book = self._create_book(entry)
+            if crawlable or book.is_catalog():
+                catalogs.append(book)
+            elif book.get_kind() == KIND_BOOK and self._match(book):
+                books.append(book)
+
+        GLib.idle_add(self._add_page_entries, page, books, catalogs)
+
+    def _add_page_entries(self, page, books, catalogs):
+        if self._cancelled:
+            return
+        if page.get('restore'):
+            page['books'].extend(books)
+            return
+        if page is not self._page or page.get('stopped'):
+            return
+        page['books'].extend(books)
+        page['catalogs'].extend(catalogs)
+        if page['shown']:
+            self.__show_entries(page, books, catalogs)
+
+    def __show_entries(self, page, books, catalogs):
+        number = page['number']
+        if number not in self._pages:
+            self._pages[number] = {'uri': page['uri'],
+                                   'start': len(self._booklist),
+                                   'end': len(self._booklist)}
+            self._loaded_pages[number] = True
+        # a book already listed in an earlier page is not added again
+        new_books = []
+        for book in books:
+            key = book.get_key()
+            if key not in self._book_pages:
+                self._book_pages[key] = number
+                new_books.append(book)
+        self._booklist.extend(new_books)
+        self._pages[number]['end'] = len(self._booklist)
+        self._cataloglist.extend(catalogs)
+        if new_books:
+            self.emit('entries-added', new_books)
+
+    def _finish_page(self, page, feedobj):
+        if self._cancelled:
+            return
+        if page.get('restore'):
+            self.__page_restored(page, feedobj)
+            return
+        if page is not self._page or page.get('stopped'):
+            return
+        # the entries are in the books already
+        page['feedobj'] = dict(feedobj, entries=[])
+        if page['shown']:
+            self.__show_page_end(page)
+
+    def __show_page_end(self, page):
+        if page['number'] == 1:
+            self._feedobj = page['feedobj']
+        elif page['feedobj'].get('bozo'):
+            logging.warning('Can not read the page %s: %s', page['uri'],
+                            page['feedobj'].get('bozo_exception'))
+        self.__show_entries(page, [], [])
+        self._next_uri = self._get_next_uri(page) or ''
+        page['books'] = []
+        page['catalogs'] = []
+        self._ready = True
+        self.__drop_pages([page['number']])
+        self.emit('updated', page['number'] > 1)
+        # the next page is downloaded while this one is looked at
+        if self._next_uri:
+            self._start_page(self._next_uri, workers.QUEUE_PREFETCH, False)
+
+    def _get_next_uri(self, page):
+        feedobj = page['feedobj']
+        if feedobj.get('bozo'):
+            return None
+        for link in feedobj['feed'].get('links', []):
+            if link.get('rel') == 'next' and link.get('href'):
+                uri = urllib.parse.urljoin(page['uri'], link['href'])
+                if uri not in self._page_uris:
+                    return uri
+        return None
 
-        for entry in feedobj['entries']:
-            if entry_type(entry) == 'BOOK' and CATALOG_TYPE != 'CRAWLABLE':
-                self._booklist.append(Book(self._configuration, entry))
-            elif entry_type(entry) == 'CATALOG' or CATALOG_TYPE == 'CRAWLABLE':
-                self._cataloglist.append(Book(self._configuration, entry))
+    def _create_book(self, entry):
+        return Book(self._configuration, entry)
 
-        self._ready = True
-        self.emit('updated', False)
+    def _match(self, book):
+        return True
 
     def __len__(self):
         return len(self._booklist)
@@ -270,31 +603,136 @@ class QueryResult(GObject.GObject):
         Returns True if more result pages are
         available for the resultset
         '''
-        if not 'links' in self._feedobj['feed']:
-            return False
-        for link in self._feedobj['feed']['links']:
-            if link['rel'] == 'next':
-                self._next_uri = link['href']
-                return True
-
-        return False
+        return len(self._next_uri) > 0 and not self._cancelled
 
     def update_with_next(self):
         '''
-        Updates the booklist with the next resultset
+        Updates the booklist with the next resultset, right away if it
+        was already prefetched
         '''
-        if len(self._next_uri) > 0:
+        page = self._page
+        if not self.has_next() or page is None:
+            return
+        if page.get('stopped'):
+            # its download was stopped by stop_pending()
+            uri, self._next_uri = self._next_uri, ''
             self._ready = False
-            self._uri = self._next_uri
-            self.cancel()  # XXX: Is this needed ?
-            self._start_download(midway=True)
+            self._start_page(uri, workers.QUEUE_FEEDS, True)
+            return
+        if page['shown']:
+            return
+        page['shown'] = True
+        self._next_uri = ''
+        self._ready = False
+        self.__show_entries(page, page['books'], page['catalogs'])
+        if page['feedobj'] is not None:
+            self.__show_page_end(page)
+
+    def set_visible_books(self, books):
+        '''
+        Tells which books are on screen, the pages they are in are kept
+        in memory or downloaded again if they were dropped
+        '''
+        numbers = []
+        for book in books:
+            number = self._book_pages.get(book.get_key())
+            if number is not None and number not in numbers:
+                numbers.append(number)
+        for number in numbers:
+            if number in self._loaded_pages:
+                self._loaded_pages.move_to_end(number)
+            elif not self._pages[number].get('restoring'):
+                self.__restore_page(number)
+        self.__drop_pages(numbers)
+
+    def __drop_pages(self, keep):
+        # the page still being shown is not complete yet
+        if self._page is not None and self._page['shown']:
+            keep = keep + [self._page['number']]
+        for number in list(self._loaded_pages.keys()):
+            if len(self._loaded_pages) <= _MAX_PAGES:
+                break
+            if number in keep:
+                continue
+            del self._loaded_pages[number]
+            logging.debug('Dropping the books of page %d', number)
+            page_info = self._pages[number]
+            replaced = []
+            for n in range(page_info['start'], page_info['end']):
+                book = self._booklist[n]
+                if not book.is_stub():
+                    stub = BookStub(book.get_key(), book.get_title(), number)
+                    self._booklist[n] = stub
+                    replaced.append((book, stub))
+            self.__books_replaced(replaced)
+
+    def __restore_page(self, number):
+        logging.debug('Downloading page %d again', number)
+        page_info = self._pages[number]
+        page_info['restoring'] = True
+        page = {'uri': page_info['uri'], 'number': number, 'books': [],
+                'catalogs': [], 'shown': False, 'feedobj': None,
+                'restore': True}
+        task = self._create_page_task(page)
+        self.threads.append(task)
+        _worker_pool.submit(workers.QUEUE_FEEDS, task)
+
+    def __page_restored(self, page, feedobj):
+        number = page['number']
+        page_info = self._pages[number]
+        # a download stopped by stop_pending() may still end here
+        page_info.pop('restoring', None)
+        books = dict([(book.get_key(), book) for book in page['books']])
+        replaced = []
+        for n in range(page_info['start'], page_info['end']):
+            stub = self._booklist[n]
+            book = books.get(stub.get_key())
+            if stub.is_stub() and book is not None:
+                self._booklist[n] = book
+                replaced.append((stub, book))
+        if not replaced and feedobj.get('bozo'):
+            # tried again the next time the page is visible
+            logging.warning('Can not download the page %s again: %s',
+                            page['uri'], feedobj.get('bozo_exception'))
+            return
+        # books gone from the catalog meanwhile stay stubs
+        self._loaded_pages[number] = True
+        self.__books_replaced(replaced)
+        self.__drop_pages([number])
+
+    def __books_replaced(self, replaced):
+        if not replaced:
+            return
+        self.emit('books-replaced', replaced)
 
     def cancel(self):
         '''
-        Cancels the query job
+        Cancels the query job, no signal is emitted afterwards
+        '''
+        self._cancelled = True
+        for d_thread in self.threads:
+            d_thread.stop()
+
+    def stop_pending(self):
+        '''
+        Stops the downloads still running, the pages already loaded are
+        kept.  A page that was being downloaded is downloaded again by
+        update_with_next(), a dropped page when it is visible again.
         '''
         for d_thread in self.threads:
             d_thread.stop()
+        self.threads = []
+        for page_info in self._pages.values():
+            page_info.pop('restoring', None)
+        page = self._page
+        if page is None or page['feedobj'] is not None or \
+                self._feedobj is None:
+            # nothing pending, or not even the first page is there
+            return
+        page['stopped'] = True
+        self._page_uris.discard(page['uri'])
+        self._next_uri = page['uri']
+        self._ready = True
 
     def get_book_n(self, n):
         '''
@@ -314,6 +752,14 @@ class QueryResult(GObject.GObject):
         '''
         return self._cataloglist
 
+    def get_error(self):
+        '''
+        Returns the exception that made the query fail, or None
+        '''
+        if self._feedobj is None:
+            return None
+        return self._feedobj.get('bozo_exception')
+
     def is_ready(self):
         '''
         Returns False if a query is in progress
@@ -329,7 +775,112 @@ class QueryResult(GObject.GObject):
         return False
 
 
+def _get_volume_index(catalog_path):
+    # a volume is indexed only once even if it is searched while its
+    # index is being built
+    with _volume_indexes_lock:
+        index = _volume_indexes.get(catalog_path)
+        if index is None or not index.is_current(os.stat(catalog_path)):
+            import catalogindex
+            index = catalogindex.load(catalog_path)
+            _volume_indexes[catalog_path] = index
+        return index
+
+
+def prepare_volume_index(path):
+    '''
+    Opens, or builds in the background, the index of the catalog of the
+    volume mounted at path, so searching it later is fast
+    '''
+    catalog_path = os.path.join(path, 'catalog.xml')
+    if os.path.exists(catalog_path):
+        _worker_pool.submit(workers.QUEUE_FEEDS,
+                            VolumeIndexTask(catalog_path, None))
+
+
+def drop_volume_index(path):
+    '''
+    Closes the index of the volume mounted at path, it must not be
+    read once the volume is unmounted
+    '''
+    catalog_path = os.path.join(path, 'catalog.xml')
+    with _volume_indexes_lock:
+        index = _volume_indexes.pop(catalog_path, None)
+    if index is not None:
+        index.close()
+
+
+class VolumeIndexTask(workers.Task):
+
+    def __init__(self, catalog_path, ready_cb):
+        workers.Task.__init__(self)
+        self._catalog_path = catalog_path
+        self._ready_cb = ready_cb
+
+    def run(self):
+        try:
+            index = _get_volume_index(self._catalog_path)
+        except Exception as e:
+            logging.error('Can not index %s: %s', self._catalog_path, e)
+            index = None
+            error = e
+        else:
+            error = None
+        if self._ready_cb is not None and not self.is_stopped():
+            self._ready_cb(index, error)
+
+
+class VolumeSearchTask(workers.Task):
+    """Searches the index of a volume.
+
+    The books are made in the worker, create_book(record) is called for
+    every match; books_cb(books) gets them in batches and
+    finished_cb(feed, catalogs, error) is called at the end, both from
+    the worker thread.
+    """
+
+    def __init__(self, catalog_path, query, configuration, create_book,
+                 books_cb, finished_cb):
+        workers.Task.__init__(self)
+        self._catalog_path = catalog_path
+        self._query = query
+        self._configuration = configuration
+        self._create_book = create_book
+        self._books_cb = books_cb
+        self._finished_cb = finished_cb
+
+    def run(self):
+        feed = {}
+        catalogs = []
+        error = None
+        try:
+            index = _get_volume_index(self._catalog_path)
+            feed = index.get_feed()
+            catalogs = [Book(self._configuration, record)
+                        for record in index.get_catalog_records()]
+            books = []
+            for number in index.search(self._query):
+                if self.is_stopped():
+                    return
+                books.append(self._create_book(index.get_book_record(number)))
+                if len(books) == _VOLUME_BATCH_SIZE:
+                    self._books_cb(books)
+                    books = []
+            if books:
+                self._books_cb(books)
+        except Exception as e:
+            logging.error('Can not search %s: %s', self._catalog_path, e)
+            error = e
+        if not self.is_stopped():
+            self._finished_cb(feed, catalogs, error)
+
+
 class LocalVolumeQueryResult(QueryResult):
+    """Searches the catalog.xml of a mounted volume.
+
+    The search runs on the catalog.idx kept next to the catalog, which is
+    built again when the catalog changes.
+    """
 
     def __init__(self, path, query, language):
         configuration = {'query_uri': os.path.join(path, 'catalog.xml')}
@@ -338,17 +889,36 @@ class LocalVolumeQueryResult(QueryResult):
     def is_local(self):
         return True
 
-    def get_book_list(self):
-        ret = []
-        if self._query is None or self._query == '':
-            for entry in self._feedobj['entries']:
-                ret.append(Book(entry, basepath=os.path.dirname(self._uri)))
+    def _start_query(self):
+        task = VolumeSearchTask(self._uri, self._query or '',
+                self._configuration, self._create_book,
+                lambda books: GLib.idle_add(self.__add_books, books),
+                lambda feed, catalogs, error: GLib.idle_add(
+                        self.__search_finished, feed, catalogs, error))
+        self.threads.append(task)
+        _worker_pool.submit(workers.QUEUE_FEEDS, task)
+
+    def __add_books(self, books):
+        if self._cancelled:
+            return
+        self._booklist.extend(books)
+        self.emit('entries-added', books)
+
+    def __search_finished(self, feed, catalogs, error):
+        if self._cancelled:
+            return
+        if error is not None:
+            self._feedobj = {'feed': feed, 'entries': [], 'bozo': 1,
+                             'bozo_exception': error}
         else:
-            for entry in self._feedobj['entries']:
-                book = Book(entry, basepath=os.path.dirname(self._uri))
-                if book.match(self._query.replace(' ', '+')):
-                    ret.append(book)
-        return ret
+            self._feedobj = {'feed': feed, 'entries': []}
+        self._cataloglist = catalogs
+        self._ready = True
+        self.emit('updated', False)
+
+    def _create_book(self, entry):
+        return Book(self._configuration, entry,
+                    basepath=os.path.dirname(self._uri))
 
 
 class RemoteQueryResult(QueryResult):
@@ -359,155 +929,229 @@ class RemoteQueryResult(QueryResult):
 
 class InternetArchiveBook(Book):
 
+    __slots__ = ('_identifier',)
+
     def __init__(self, configuration, entry, basepath=None):
         Book.__init__(self, configuration, entry, basepath=None)
+        self._identifier = entry['identifier']
+        self._id = self._identifier
+
+    def _classify_links(self, entry):
+        # the csv search results only tell which formats exist
+        self._kind = KIND_BOOK
+        self._types = entry['links']
+        self._image_urls = {'jpg': entry['cover_image']}
+
+    def get_files(self):
+        '''
+        Returns {content type: (file name, size)} read from the
+        {identifier}_files.xml file list, or None if it is not known yet
+        '''
+        if _manifest_cache is None:
+            return None
+        return _manifest_cache.get(self._identifier)
 
     def get_types(self):
-        return self._entry['links']
+        # the csv only has a rough list of formats, the file list tells
+        # what can really be downloaded
+        files = self.get_files()
+        if files is None:
+            return self._types
+        return dict([(content_type, 'yes') for content_type in files])
+
+    def fetch_files(self, ready_cb):
+        '''
+        Downloads the file list; ready_cb(book, files) is called from the
+        main loop, files is None if the list could not be read.  Returns a
+        ManifestFetch, cancel() it when the list is not needed any more.
+        '''
+        # the list is read until the formats of the csv are found
+        return _fetch_manifest(self._identifier, list(self._types),
+                               lambda files: ready_cb(self, files))
 
-    def get_download_links(self, content_type, download_cb, path):
+    def get_download_links(self, content_type, download_cb, error_cb):
         """
-        Download and parse the {identifier}_files.xml file list in the
-        {identifier} directory and choose a file matching the
-        requested content type.
+        Choose a file matching the requested content type from the
+        {identifier}_files.xml file list in the {identifier} directory,
+        downloading the list first if it is not cached.
         """
-        url_base = 'http://archive.org/download/%s' % self._entry['identifier']
-        url = os.path.join(url_base, '%s_files.xml' % self._entry['identifier'])
-
-        downloader = FileDownloader(url, path)
+        url_base = 'http://archive.org/download/%s' % self._identifier
 
-        def updated(downloader, path, _):
-            if path is None:
+        def ready_cb(book, files):
+            if files is None:
                 logging.error('internet archive file list get fail')
-                # FIXME: report to user a failure to download
-                return 1
-
-            from xml.etree.ElementTree import XML
-            xml = XML(open(path, 'r').read())
-            os.remove(path)
-
-            table = {
-                'text pdf': 'application/pdf',
-                'grayscale luratech pdf': 'application/pdf-bw',
-                'image container pdf': 'application/pdf',
-                'djvu': 'image/x.djvu',
-                'epub': 'application/epub+zip',
-            }
-
-            chosen = None
-            for element in xml.findall('file'):
-                fmt = element.find('format').text.lower()
-                if fmt in table:
-                    if table[fmt] == content_type:
-                        chosen = element.get('name')
-                        break
-
-            if chosen is None:
+                error_cb(None)
+                return
+            if content_type not in files:
                 logging.error('internet archive file list omits content type')
-                # FIXME: report to user a failure to find matching content
-                return 1
-
-            url = os.path.join(url_base, chosen)
-            GLib.idle_add(download_cb, url)
+                error_cb(files)
+                return
+            download_cb(os.path.join(url_base, files[content_type][0]))
 
-        downloader.connect('updated', updated)
-
-    def get_image_url(self):
-        return {'jpg': self._entry['cover_image']}
+        files = self.get_files()
+        if files is not None:
+            GLib.idle_add(ready_cb, self, files)
+        else:
+            self.fetch_files(ready_cb)
 
 
-class InternetArchiveDownloadThread(threading.Thread):
+class ManifestFetch(object):
+    """A caller waiting for the file list of an Internet Archive item.
 
-    def __init__(self, query, path, updated_cb, append_cb, ready_cb, parent=None):
-        threading.Thread.__init__(self)
-        self.parent = parent
-        self._path = path
-        self._updated_cb = updated_cb
-        self._append_cb = append_cb
-        self._ready_cb = ready_cb
+    The list is downloaded once for all the callers of an item; the
+    download is stopped when every caller was cancelled.
+    """
 
-        self._download_content_length = 0
-        self._download_content_type = None
+    def __init__(self, identifier, callback):
+        self._identifier = identifier
+        self.callback = callback
 
-        FL = urllib.parse.quote('fl[]')
-        SORT = urllib.parse.quote('sort[]')
-        self._url = 'http://archive.org/advancedsearch.php?q=' +  \
-            urllib.parse.quote('(title:(' + query.lower() + ') OR ' + \
-            'creator:(' + query.lower() + ')) AND format:(DJVU)')
-        self._url += '&' + FL + '=creator&' + FL + '=description&' + \
-            FL + '=format&' + FL + '=identifier&' + FL + '=language'
-        self._url += '&' + FL + '=publisher&' + FL + '=title&' + \
-            FL + '=volume'
-        self._url += '&' + SORT + '=title&' + SORT + '&' + \
-            SORT + '=&rows=500&save=yes&fmt=csv&xmlsearch=Search'
-        self.stopthread = threading.Event()
+    def cancel(self):
+        fetch = _manifest_requests.get(self._identifier)
+        if fetch is None or self not in fetch['callers']:
+            return
+        fetch['callers'].remove(self)
+        if not fetch['callers']:
+            del _manifest_requests[self._identifier]
+            fetch['request'].cancel()
+
+
+def _fetch_manifest(identifier, content_types, callback):
+    # one download per identifier, every caller gets its result
+    caller = ManifestFetch(identifier, callback)
+    if identifier in _manifest_requests:
+        _manifest_requests[identifier]['callers'].append(caller)
+        return caller
+    # parsed on the network thread as it arrives
+    parser = iamanifests.ManifestParser(content_types)
+    request = get_net_engine().fetch(iamanifests.get_url(identifier),
+            _manifest_ready_cb, consumer=parser.feed,
+            user_data=(identifier, parser))
+    _manifest_requests[identifier] = {'request': request,
+                                      'callers': [caller]}
+    return caller
+
+
+def _manifest_ready_cb(response, error, user_data):
+    identifier, parser = user_data
+    files = None
+    if error is None:
+        try:
+            parser.close()
+            files = parser.files
+        except Exception as e:
+            logging.warning('Can not read the files of %s: %s', identifier,
+                            e)
+    if files is not None and _manifest_cache is not None:
+        _manifest_cache.store(identifier, files)
+    fetch = _manifest_requests.pop(identifier, None)
+    if fetch is None:
+        return
+    for caller in fetch['callers']:
+        caller.callback(files)
+
+
+def _get_internet_archive_entry(row):
+    # row of the advancedsearch csv -> entry for InternetArchiveBook
+    entry = {}
+    entry['author'] = row[0]
+    entry['description'] = row[1]
+    entry['format'] = row[2]
+    entry['identifier'] = row[3]
+    entry['dcterms_language'] = row[4]
+    entry['dcterms_publisher'] = row[5]
+    entry['title'] = row[6]
+    volume = row[7]
+    if volume is not None and len(volume) > 0:
+        entry['title'] = row[6] + 'Volume ' + volume
+
+    entry['links'] = {}
+    formats = entry['format'].split(',')
+    if 'DjVu' in formats:
+        entry['links']['image/x.djvu'] = 'yes'
+    if entry['format'].find('Grayscale LuraTech PDF') > -1:
+        # Fake mime type
+        entry['links']['application/pdf-bw'] = 'yes'
+    if entry['format'].find('PDF') > -1:
+        entry['links']['application/pdf'] = 'yes'
+    if entry['format'].find('EPUB') > -1:
+        entry['links']['application/epub+zip'] = 'yes'
+    entry['cover_image'] = 'http://archive.org/download/' + \
+                row[3] + '/page/cover_thumb.jpg'
+    return entry
+
+
+def _get_internet_archive_url(query, page):
+    FL = urllib.parse.quote('fl[]')
+    SORT = urllib.parse.quote('sort[]')
+    url = 'http://archive.org/advancedsearch.php?q=' +  \
+        urllib.parse.quote('(title:(' + query.lower() + ') OR ' + \
+        'creator:(' + query.lower() + ')) AND format:(DJVU)')
+    url += '&' + FL + '=creator&' + FL + '=description&' + \
+        FL + '=format&' + FL + '=identifier&' + FL + '=language'
+    url += '&' + FL + '=publisher&' + FL + '=title&' + \
+        FL + '=volume'
+    url += '&' + SORT + '=title&' + SORT + '&' + \
+        SORT + '=&rows=%d&page=%d&save=yes&fmt=csv&xmlsearch=Search' % \
+        (_IA_PAGE_SIZE, page)
+    return url
+
+
+class InternetArchiveDownloadThread(workers.Task):
+    """Reads a page of the csv of an advancedsearch query as it arrives.
+
+    books_cb(books) is called with every _IA_BATCH_SIZE books parsed,
+    finished_cb(error) once the response ends; both from the worker.
+    """
+
+    def __init__(self, url, books_cb, finished_cb):
+        workers.Task.__init__(self)
+        self._url = url
+        self._books_cb = books_cb
+        self._finished_cb = finished_cb
 
     def run(self):
         logging.debug('Searching URL %s', self._url)
-        getter = ReadURLDownloader(self._url)
-        getter.connect("finished", self.__finished_cb)
-        getter.connect("error", self.__error_cb)
+        error = None
         try:
-            getter.start(self._path)
+            response = _get_connection_pool().urlopen(self._url,
+                    cancel_token=self.token)
+            self.token.register(response)
+            try:
+                self.__read_books(response)
+            finally:
+                self.token.unregister(response)
+                response.close()
         except Exception as e:
-            logging.warning('Error {} has occurred'.format(e))
-        self._download_content_type = getter.get_content_type()
-
-    def __error_cb(self, getter, err):
-        self._download_content_length = 0
-        self._download_content_type = None
-
-    def __finished_cb(self, getter, path, suggested_name):
-        if self._download_content_type.startswith('text/html'):
+            if not self.is_stopped():
+                logging.warning('Error {} has occurred'.format(e))
+            error = e
+        if not self.is_stopped():
+            self._finished_cb(error)
+
+    def __read_books(self, response):
+        if response.headers.get('Content-Type', '').startswith('text/html'):
             # got an error page instead
-            self._get_csv_error_cb(getter, 'HTTP Error')
-            return
+            raise IOError('HTTP Error')
 
-        reader = csv.reader(open(path,  'r'))
+        # the rows are parsed from the socket, no need to wait for the
+        # end of the response
+        import csv
+        reader = csv.reader(io.TextIOWrapper(response, encoding='utf-8',
+                                             newline=''))
         next(reader)
         next(reader) # skip the first two header rows.
+        books = []
         for row in reader:
-            if len(row) < 7:
+            if self.is_stopped() or len(row) < 8:
                 break
-            entry = {}
-            entry['author'] = row[0]
-            entry['description'] = row[1]
-            entry['format'] = row[2]
-            entry['identifier'] = row[3]
-            entry['dcterms_language'] = row[4]
-            entry['dcterms_publisher'] = row[5]
-            entry['title'] = row[6]
-            volume = row[7]
-            if volume is not None and len(volume) > 0:
-                entry['title'] = row[6] + 'Volume ' + volume
-
-            entry['links'] = {}
-            url_base = 'http://archive.org/download/' + \
-                        row[3] + '/' + row[3]
-
-            formats = entry['format'].split(',')
-            if 'DjVu' in formats:
-                entry['links']['image/x.djvu'] = 'yes'
-            if entry['format'].find('Grayscale LuraTech PDF') > -1:
-                # Fake mime type
-                entry['links']['application/pdf-bw'] = 'yes'
-            if entry['format'].find('PDF') > -1:
-                entry['links']['application/pdf'] = 'yes'
-            if entry['format'].find('EPUB') > -1:
-                entry['links']['application/epub+zip'] = 'yes'
-            entry['cover_image'] = 'http://archive.org/download/' + \
-                        row[3] + '/page/cover_thumb.jpg'
-            if InternetArchiveBook(None, entry, ''):
-                self._append_cb(InternetArchiveBook(None, entry, ''))
-            else:
-                self.parent.show_alert_cb(_('No Books found'))
-
-        os.remove(path)
-        self._updated_cb()
-        self._ready_cb()
-
-    def stop(self):
-        self.stopthread.set()
+            books.append(InternetArchiveBook(None,
+                         _get_internet_archive_entry(row), ''))
+            if len(books) == _IA_BATCH_SIZE:
+                self._books_cb(books)
+                books = []
+        if books and not self.is_stopped():
+            self._books_cb(books)
 
 
 class InternetArchiveQueryResult(QueryResult):
@@ -515,81 +1159,397 @@ class InternetArchiveQueryResult(QueryResult):
     # Search in internet archive does not use OPDS
     # because the server implementation is not working very well
 
-    def __init__(self, query, path, parent=None):
-        GObject.GObject.__init__(self)
-        self._next_uri = ''
-        self._ready = False
-        self._booklist = []
-        self._cataloglist = []
-        self.threads = []
+    def __init__(self, query):
+        QueryResult.__init__(self, {'query_uri': None}, query, None)
+
+    def _start_query(self):
+        self._start_page(_get_internet_archive_url(self._query, 1),
+                         workers.QUEUE_FEEDS, True)
+
+    def _create_page_task(self, page):
+        return InternetArchiveDownloadThread(page['uri'],
+                lambda books: GLib.idle_add(self._add_page_entries, page,
+                                            books, []),
+                lambda error: GLib.idle_add(self._finish_page, page,
+                                            self.__get_feedobj(error)))
+
+    def __get_feedobj(self, error):
+        if error is None:
+            return {'feed': {}, 'entries': []}
+        return {'feed': {}, 'entries': [], 'bozo': 1,
+                'bozo_exception': error}
+
+    def _get_next_uri(self, page):
+        # the csv does not tell how many books were found, a full page
+        # may be followed by more
+        if page['feedobj'].get('bozo') or \
+                len(page['books']) < _IA_PAGE_SIZE:
+            return None
+        return _get_internet_archive_url(self._query, page['number'] + 1)
+
+
+def _get_if_range(validators):
+    # If-Range needs a strong etag or a date
+    etag = validators.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return validators.get('modified')
+
+
+def _parse_content_range(content_range):
+    # 'bytes first-last/total' -> (first, total), total is None if unknown
+    unit, sep, byte_range = content_range.strip().partition(' ')
+    span, sep, total = byte_range.partition('/')
+    first = int(span.split('-')[0])
+    if total.strip() in ('', '*'):
+        return first, None
+    return first, int(total)
+
+
+class SegmentTask(workers.Task):
+    """One byte range of a segmented download.
+
+    The range is run by a worker of the pool, or by the download itself
+    when no worker took it yet, so a busy queue never holds the download.
+    """
+
+    def __init__(self, fetch, n):
+        workers.Task.__init__(self)
+        self._fetch = fetch
+        self._n = n
+        self._lock = threading.Lock()
+        self._claimed = False
+        self.done = threading.Event()
 
-        d_thread = InternetArchiveDownloadThread(query, path,
-                                                 self.__updated_cb,
-                                                 self.__append_cb,
-                                                 self.__ready_cb,
-                                                 parent)
-        d_thread.daemon = True
-        self.threads.append(d_thread)
-        d_thread.start()
-
-    def __updated_cb(self):
-        self.emit('updated', False)
-
-    def __append_cb(self, book):
-        self._booklist.append(book)
-
-    def __ready_cb(self):
-        self._ready = True
+    def run(self):
+        with self._lock:
+            if self._claimed:
+                return
+            self._claimed = True
+        try:
+            self._fetch(self._n, None)
+        finally:
+            self.done.set()
 
 
-class FileDownloaderThread(threading.Thread):
+class FileDownloaderThread(workers.Task):
 
-    def __init__(self, url, path, updated_cb, progress_cb):
-        threading.Thread.__init__(self)
+    def __init__(self, url, path, updated_cb, progress_cb, resumable=False,
+                 segments=1, queue_name=workers.QUEUE_BOOKS):
+        workers.Task.__init__(self)
+        self._url = url
         self._path = path
         self._updated_cb = updated_cb
         self._progress_cb = progress_cb
-        self._getter = ReadURLDownloader(url)
         self._download_content_length = 0
         self._download_content_type = None
-        self.stopthread = threading.Event()
+        self._store = _partial_store if resumable else None
+        # True once the server sent, or the store holds, what is needed to
+        # resume
+        self._can_resume = False
+        # False while the current attempt is still connecting
+        self._got_headers = False
+        self._segments = segments
+        self._queue_name = queue_name
 
     def run(self):
-        self._getter.connect("finished", self.__result_cb)
-        self._getter.connect("progress", self.__progress_cb)
-        self._getter.connect("error", self.__error_cb)
+        attempt = 0
+        while True:
+            try:
+                self.__download()
+                break
+            except Exception as e:
+                if self.is_stopped():
+                    self.__stopped()
+                    return
+                # nothing was received if the connection failed, so it is
+                # worth trying again even when the download can not resume
+                connecting = not self._got_headers and \
+                        not isinstance(e, urllib.error.HTTPError)
+                if not (self._can_resume or connecting) or \
+                        attempt == _RETRIES:
+                    logging.error('Could not download %s: %s', self._url, e)
+                    self.__error_cb()
+                    return
+                attempt += 1
+                logging.debug('Download of %s failed (%s), retry %d',
+                              self._url, e, attempt)
+                if self.token.wait(2 ** attempt):
+                    self.__stopped()
+                    return
+
+        if self.is_stopped():
+            self.__stopped()
+            return
+        if self._store is not None:
+            self._store.finish(self._url, self._path)
+        self._updated_cb(self._path, self._download_content_type)
+
+    def __open(self):
+        offset, validators, segments = 0, None, None
+        if self._store is not None:
+            offset, validators = self._store.get(self._url)
+        if validators is not None and validators.get('segments'):
+            # a segmented download, the part file has its final size and
+            # the ranges still missing are in the validators
+            if offset == validators.get('length'):
+                segments = validators['segments']
+                offset = segments[0][0]
+            else:
+                self._store.discard(self._url)
+                offset, validators = 0, None
+        import urllib.request
+        request = urllib.request.Request(self._url)
+        self._got_headers = False
+        self._can_resume = False
+        if offset > 0 or segments:
+            if_range = _get_if_range(validators)
+            if if_range is None:
+                self._store.discard(self._url)
+                offset = 0
+            else:
+                logging.debug('Resuming %s at %d', self._url, offset)
+                # kept even if the server can not be reached
+                self._can_resume = True
+                request.add_header('Range', 'bytes=%d-' % offset)
+                request.add_header('If-Range', if_range)
         try:
-            self._getter.start(self._path)
-        except:
-            self._updated_cb(None, None)
-
-        self._download_content_length = \
-                self._getter.get_content_length()
-        self._download_content_type = self._getter.get_content_type()
-
-    def __result_cb(self, getter, path, suggested_name):
-        self._getter = None
-        if not self.stopthread.is_set():
-            self._updated_cb(path, self._download_content_type)
-
-    def __progress_cb(self, getter, bytes_downloaded):
-        if self.stopthread.is_set():
+            response = _get_connection_pool().urlopen(request,
+                    cancel_token=self.token)
+        except urllib.error.HTTPError as e:
+            if e.code != 416 or offset == 0:
+                raise
+            # the partial file does not match the one on the server
+            e.close()
+            self._store.discard(self._url)
+            return self.__open()
+        return response, offset, validators, segments
+
+    def __download(self):
+        response, offset, validators, segments = self.__open()
+        self._got_headers = True
+        self.token.register(response)
+        try:
+            headers = response.headers
+            if getattr(response, 'status', None) == 206:
+                first, total = _parse_content_range(
+                        headers.get('Content-Range', ''))
+                if first != offset:
+                    self._store.discard(self._url)
+                    raise IOError('Got the range from %d instead of %d' %
+                                  (first, offset))
+                if total is None:
+                    total = offset + int(headers.get('Content-Length', 0))
+                self._download_content_length = total
+                self._download_content_type = validators['content_type']
+                self._can_resume = True
+                mode = 'ab'
+            else:
+                # a new download, or the file changed on the server
+                offset = 0
+                segments = None
+                length = headers.get('Content-Length')
+                if length is not None:
+                    self._download_content_length = int(length)
+                self._download_content_type = headers.get('Content-Type')
+                self.__start_partial(headers)
+                mode = 'wb'
+
+            target = self._path
+            if self._store is not None:
+                target = self._store.get_part_path(self._url)
+            if_range = _get_if_range({'etag': headers.get('ETag'),
+                                      'modified': headers.get('Last-Modified')})
+            if if_range is None and validators is not None:
+                if_range = _get_if_range(validators)
+            if segments:
+                self.__download_segments(response, target, segments,
+                                         if_range)
+                return
+            if self.__can_split(response, offset, if_range):
+                total = self._download_content_length
+                count = min(self._segments,
+                            (total - offset) // _MIN_SEGMENT_SIZE)
+                size = (total - offset) // count
+                segments = [[offset + size * n,
+                             offset + size * (n + 1) if n < count - 1
+                             else total] for n in range(count)]
+                # the file gets its final size now, every segment writes
+                # its part; the ranges are saved first so they are resumed
+                # and not the size of the file
+                self.__save_segments(segments)
+                with open(target, 'r+b' if mode == 'ab' else 'wb') as f:
+                    f.truncate(total)
+                self.__download_segments(response, target, segments,
+                                         if_range)
+                return
+
+            bytes_downloaded = offset
+            with open(target, mode) as f:
+                while not self.is_stopped():
+                    data = response.read(_CHUNK_SIZE)
+                    if not data:
+                        break
+                    f.write(data)
+                    bytes_downloaded += len(data)
+                    self.__progress_cb(bytes_downloaded)
+            if not self.is_stopped() and self._download_content_length and \
+                    bytes_downloaded < self._download_content_length:
+                raise IOError('Connection closed after %d of %d bytes' %
+                              (bytes_downloaded,
+                               self._download_content_length))
+        finally:
+            self.token.unregister(response)
+            response.close()
+
+    def __can_split(self, response, offset, if_range):
+        # the ranges are asked with If-Range so they all come from the
+        # same version of the file
+        ranges = getattr(response, 'status', None) == 206 or \
+                response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+        return self._segments > 1 and ranges and if_range is not None and \
+                self._download_content_length - offset >= \
+                2 * _MIN_SEGMENT_SIZE
+
+    def __save_segments(self, segments):
+        if self._store is not None:
+            self._store.save_segments(self._url, segments)
+
+    def __download_segments(self, response, target, ranges, if_range):
+        '''
+        Fetches the [start, end) ranges of the part file, the first one
+        from response, at most self._segments of them at once
+        '''
+        total = self._download_content_length
+        count = len(ranges)
+        offset = total - sum([end - start for start, end in ranges])
+        logging.debug('Downloading %s in %d segments', self._url, count)
+        import urllib.request
+        received = [0] * count
+        # bytes received since the missing ranges were last saved
+        unsaved = [0]
+        errors = []
+        lock = threading.Lock()
+        # cancelled by the first segment that fails, so the others stop
+        failed = workers.CancelToken()
+
+        def get_missing():
+            return [[start + received[n], end]
+                    for n, (start, end) in enumerate(ranges)
+                    if start + received[n] < end]
+
+        def fetch(n, segment_response):
+            start, end = ranges[n]
+            opened = segment_response is None
             try:
-                getter.cancel()
-            except:
-                pass
+                if not opened:
+                    failed.register(segment_response)
+                elif failed.is_cancelled() or self.is_stopped():
+                    return
+                else:
+                    request = urllib.request.Request(self._url)
+                    request.add_header('Range',
+                                       'bytes=%d-%d' % (start, end - 1))
+                    request.add_header('If-Range', if_range)
+                    segment_response = _get_connection_pool().urlopen(
+                            request, cancel_token=self.token)
+                    self.token.register(segment_response)
+                    failed.register(segment_response)
+                    if getattr(segment_response, 'status', None) != 206 or \
+                            _parse_content_range(segment_response.headers.get(
+                                'Content-Range', ''))[0] != start:
+                        raise IOError('The server did not send the range '
+                                      'from %d' % start)
+                position = start
+                # unbuffered, so what is saved as received is in the file
+                # even if the activity is killed
+                with open(target, 'r+b', buffering=0) as f:
+                    f.seek(start)
+                    while position < end and not self.is_stopped() and \
+                            not failed.is_cancelled():
+                        data = segment_response.read(
+                                min(_CHUNK_SIZE, end - position))
+                        if not data:
+                            break
+                        f.write(data)
+                        position += len(data)
+                        with lock:
+                            received[n] += len(data)
+                            unsaved[0] += len(data)
+                            if unsaved[0] >= _SEGMENTS_SAVE_SIZE:
+                                unsaved[0] = 0
+                                self.__save_segments(get_missing())
+                            self.__progress_cb(offset + sum(received))
+                if position < end and not self.is_stopped() and \
+                        not failed.is_cancelled():
+                    raise IOError('Connection closed in the range from %d' %
+                                  start)
+            except Exception as e:
+                if not failed.is_cancelled():
+                    errors.append(e)
+                failed.cancel()
+            finally:
+                if opened and segment_response is not None:
+                    self.token.unregister(segment_response)
+                    segment_response.close()
+
+        tasks = [SegmentTask(fetch, n) for n in range(1, count)]
+        for task in tasks[:self._segments - 1]:
+            _worker_pool.submit(self._queue_name, task)
+        # the response already open carries the first segment
+        fetch(0, response)
+        for task in tasks:
+            # the ranges no worker started yet are fetched here
+            task.run()
+        for task in tasks:
+            task.done.wait()
+
+        if errors or self.is_stopped():
+            # resumed from the ranges still missing
+            with lock:
+                self.__save_segments(get_missing())
+            if errors and not self.is_stopped():
+                raise errors[0]
+
+    def __start_partial(self, headers):
+        if self._store is None:
+            return
+        validators = {'etag': headers.get('ETag'),
+                      'modified': headers.get('Last-Modified'),
+                      'length': self._download_content_length,
+                      'content_type': self._download_content_type}
+        self._can_resume = \
+                headers.get('Accept-Ranges', '').lower() != 'none' and \
+                _get_if_range(validators) is not None
+        if self._can_resume:
+            self._store.start(self._url, validators)
+        else:
+            self._store.discard(self._url)
+
+    def __progress_cb(self, bytes_downloaded):
         self._progress_cb(float(bytes_downloaded) / \
                           float(self._download_content_length + 1))
 
-    def __error_cb(self, getter, err):
+    def __stopped(self):
+        # a cancelled download is resumed the next time it is asked for
+        if self._store is None:
+            self.__remove(self._path)
+        elif not self._can_resume and self._got_headers:
+            self._store.discard(self._url)
+
+    def __remove(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+
+    def __error_cb(self):
         self._download_content_length = 0
         self._download_content_type = None
-        self._getter = None
+        if self._store is None:
+            self.__remove(self._path)
+        elif not self._can_resume and self._got_headers:
+            self._store.discard(self._url)
         self._updated_cb(None, None)
 
-    def stop(self):
-        self.stopthread.set()
-
 
 class FileDownloader(GObject.GObject):
 
@@ -602,22 +1562,34 @@ class FileDownloader(GObject.GObject):
                           ([GObject.TYPE_FLOAT])),
     }
 
-    def __init__(self, url, path):
+    def __init__(self, url, path, queue_name=workers.QUEUE_BOOKS,
+                 resumable=False, segments=1):
         GObject.GObject.__init__(self)
         self.threads = []
+        self._percent = -1
+        self._stopped = False
 
         d_thread = FileDownloaderThread(url, path, self.__updated_cb,
-                                        self.__progress_cb)
-        d_thread.daemon = True
+                                        self.__progress_cb, resumable,
+                                        segments, queue_name)
         self.threads.append(d_thread)
-        d_thread.start()
+        _worker_pool.submit(queue_name, d_thread)
 
     def __updated_cb(self, path, content_type):
-        self.emit('updated', path, content_type)
+        GLib.idle_add(self.__emit, 'updated', path, content_type)
 
     def __progress_cb(self, progress):
-        self.emit('progress', progress)
+        # do not flood the main loop, a percent is enough for a progress bar
+        percent = int(progress * 100)
+        if percent != self._percent:
+            self._percent = percent
+            GLib.idle_add(self.__emit, 'progress', progress)
+
+    def __emit(self, signal, *args):
+        if not self._stopped:
+            self.emit(signal, *args)
 
     def stop(self):
+        self._stopped = True
         for thread in self.threads:
             thread.stop()
@@ -0,0 +1,364 @@
+#! /usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Atom/OPDS parser that only extracts what opds.Book uses.
+
+Entries are plain dicts with the same keys feedparser uses for them
+('title', 'author', 'links', 'dcterms_language', 'dcterms_publisher',
+'published', 'summary', 'id'), so both parsers can feed opds.  Documents
+expat can not parse are handed over to feedparser.
+"""
+
+import calendar
+import io
+import logging
+import urllib.parse, urllib.error
+import zlib
+from xml.parsers import expat
+
+_NS_ATOM = 'http://www.w3.org/2005/Atom'
+_NS_DCTERMS = 'http://purl.org/dc/terms/'
+
+REL_CRAWLABLE = 'http://opds-spec.org/crawlable'
+# links to other catalogs
+NAVIGATION_RELS = ('http://opds-spec.org/sort/popular',
+                   'http://opds-spec.org/sort/new', 'subsection')
+
+KIND_BOOK = 'BOOK'
+KIND_CATALOG = 'CATALOG'
+
+CHUNK_SIZE = 8192
+USER_AGENT = 'GetBooks (+https://github.com/sugarlabs/get-books-activity)'
+
+# (namespace, element) inside an entry -> record key
+_ENTRY_FIELDS = {
+    (_NS_ATOM, 'title'): 'title',
+    (_NS_ATOM, 'summary'): 'summary',
+    (_NS_ATOM, 'content'): 'content',
+    (_NS_ATOM, 'published'): 'published',
+    (_NS_ATOM, 'id'): 'id',
+    (_NS_DCTERMS, 'issued'): 'published',
+    (_NS_DCTERMS, 'language'): 'dcterms_language',
+    (_NS_DCTERMS, 'publisher'): 'dcterms_publisher',
+}
+
+_FEED_FIELDS = {
+    (_NS_ATOM, 'title'): 'title',
+    (_NS_ATOM, 'id'): 'id',
+}
+
+
+def _split_name(name):
+    if ' ' in name:
+        return tuple(name.split(' ', 1))
+    # elements without a namespace are taken as atom
+    return (_NS_ATOM, name)
+
+
+class OPDSParser(object):
+    """Incremental parser, call feed_data() as data arrives.
+
+    Entries are appended to finished_entries as soon as their closing tag
+    has been parsed; the caller takes them from there.
+    """
+
+    def __init__(self, baseuri=''):
+        self.feed = {'links': []}
+        self.entries = []
+        self.finished_entries = []
+        self._baseuri = baseuri
+        self._entry = None
+        self._depth = 0
+        self._entry_depth = None
+        self._capture = None
+        self._capture_depth = None
+        self._text = []
+        self._parser = expat.ParserCreate(namespace_separator=' ')
+        self._parser.buffer_text = True
+        self._parser.StartElementHandler = self._start_element
+        self._parser.EndElementHandler = self._end_element
+        self._parser.CharacterDataHandler = self._character_data
+
+    def feed_data(self, data):
+        self._parser.Parse(data, False)
+
+    def close(self):
+        self._parser.Parse(b'', True)
+
+    def _start_element(self, name, attrs):
+        self._depth += 1
+        if self._capture is not None:
+            return
+        key = _split_name(name)
+        if self._entry is None:
+            if key == (_NS_ATOM, 'entry'):
+                self._entry = {'links': []}
+                self._entry_depth = self._depth
+            elif self._depth == 2:
+                if key == (_NS_ATOM, 'link'):
+                    self.feed['links'].append(self._get_link(attrs))
+                elif key in _FEED_FIELDS:
+                    self._start_capture(_FEED_FIELDS[key])
+            return
+
+        relative_depth = self._depth - self._entry_depth
+        if relative_depth == 1:
+            if key == (_NS_ATOM, 'link'):
+                self._entry['links'].append(self._get_link(attrs))
+            elif key in _ENTRY_FIELDS:
+                self._start_capture(_ENTRY_FIELDS[key])
+        elif relative_depth == 2 and key == (_NS_ATOM, 'name') and \
+                'author' not in self._entry:
+            self._start_capture('author')
+
+    def _end_element(self, name):
+        if self._capture is not None and self._depth == self._capture_depth:
+            value = ''.join(self._text).strip()
+            target = self.feed if self._entry is None else self._entry
+            if self._capture not in target:
+                target[self._capture] = value
+            self._capture = None
+            self._text = []
+        elif self._entry is not None and self._depth == self._entry_depth:
+            if 'summary' not in self._entry and 'content' in self._entry:
+                self._entry['summary'] = self._entry['content']
+            self._entry.pop('content', None)
+            self.entries.append(self._entry)
+            self.finished_entries.append(self._entry)
+            self._entry = None
+        self._depth -= 1
+
+    def _character_data(self, data):
+        if self._capture is not None:
+            self._text.append(data)
+
+    def _start_capture(self, field):
+        self._capture = field
+        self._capture_depth = self._depth
+        self._text = []
+
+    def _get_link(self, attrs):
+        link = {'rel': attrs.get('rel', 'alternate')}
+        if link['rel'] == 'self':
+            link['type'] = attrs.get('type', 'application/atom+xml')
+        else:
+            link['type'] = attrs.get('type', 'text/html')
+        if 'href' in attrs:
+            href = attrs['href']
+            if self._baseuri:
+                href = urllib.parse.urljoin(self._baseuri, href)
+            link['href'] = href
+        if 'title' in attrs:
+            link['title'] = attrs['title']
+        return link
+
+
+def parse(data, baseuri=''):
+    '''
+    Parses a whole document (bytes), returns (feed, entries)
+    '''
+    parser = OPDSParser(baseuri)
+    parser.feed_data(data)
+    parser.close()
+    return parser.feed, parser.entries
+
+
+def get_entry_kind(entry):
+    '''
+    Returns KIND_BOOK, KIND_CATALOG or None for an entry without links
+    '''
+    # the first link tells if the entry is a book or a catalog
+    for link in entry.get('links', []):
+        if link['rel'] in NAVIGATION_RELS:
+            return KIND_CATALOG
+        return KIND_BOOK
+    return None
+
+
+def is_crawlable(feed):
+    for link in feed.get('links', []):
+        if link['rel'] == REL_CRAWLABLE:
+            return True
+    return False
+
+
+def _record_from_entry(entry):
+    record = {'links': []}
+    for key in ('title', 'author', 'dcterms_language', 'dcterms_publisher',
+                'published', 'summary', 'id'):
+        if key in entry:
+            record[key] = entry[key]
+    for link in entry.get('links', []):
+        record['links'].append(dict([(key, link[key])
+                for key in ('rel', 'type', 'href', 'title') if key in link]))
+    return record
+
+
+def _parse_with_feedparser(data, headers):
+    import feedparser
+    feedobj = feedparser.parse(io.BytesIO(data), response_headers=headers)
+    feed = _record_from_entry(feedobj['feed'])
+    entries = [_record_from_entry(entry) for entry in feedobj['entries']]
+    return feed, entries, feedobj.get('bozo_exception')
+
+
+def _format_modified(modified):
+    if isinstance(modified, str):
+        return modified
+    # a time tuple in GMT, as stored by feedparser
+    import email.utils
+    return email.utils.formatdate(calendar.timegm(tuple(modified)[:9]),
+                                  usegmt=True)
+
+
+def _open(uri, etag, modified, handlers, request_headers):
+    # not imported before the first download, it is slow to load
+    import urllib.request
+    if not urllib.parse.urlparse(uri)[0] in ('http', 'https', 'ftp', 'file'):
+        return open(uri, 'rb')
+    request = urllib.request.Request(uri)
+    request.add_header('User-Agent', USER_AGENT)
+    request.add_header('Accept-encoding', 'gzip, deflate')
+    if etag:
+        request.add_header('If-None-Match', etag)
+    if modified:
+        request.add_header('If-Modified-Since', _format_modified(modified))
+    for header_name, header_value in list(request_headers.items()):
+        request.add_header(header_name, header_value)
+    opener = urllib.request.build_opener(*handlers)
+    return opener.open(request)
+
+
+def _is_cancelled(cancel_token):
+    return cancel_token is not None and cancel_token.is_cancelled()
+
+
+def parse_incremental(uri, entries_cb, etag=None, modified=None,
+                      handlers=[], request_headers={}, cancel_token=None):
+    '''
+    Fetches and parses the feed at uri (an url or a file name).
+
+    entries_cb(feed, entries) is called from the reading thread every time
+    a chunk completed one or more entries.  Documents the fast parser
+    rejects are parsed again by feedparser, and only the entries that were
+    not delivered yet are passed to entries_cb.
+
+    cancel_token, if given, needs is_cancelled() and register(resource)
+    methods.  The opened stream is registered with it, and once it is
+    cancelled parsing stops, entries_cb is not called anymore and the
+    entries parsed so far are returned.  Returns a dict with 'feed', 'entries', 'status', 'etag', 'modified', 'headers'
+    and, after a failure, 'bozo' and 'bozo_exception'.
+    '''
+    result = {'feed': {'links': []}, 'entries': [], 'bozo': 0}
+    try:
+        f = _open(uri, etag, modified, handlers, request_headers)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            result['status'] = 304
+            result['headers'] = dict(e.headers)
+        else:
+            result['bozo'] = 1
+            result['bozo_exception'] = e
+        e.close()
+        return result
+    except Exception as e:
+        result['bozo'] = 1
+        result['bozo_exception'] = e
+        return result
+    if cancel_token is not None:
+        cancel_token.register(f)
+
+    headers = dict(getattr(f, 'headers', None) or {})
+    result['headers'] = headers
+    content_encoding = ''
+    for key in headers:
+        if key.lower() == 'etag':
+            result['etag'] = headers[key]
+        elif key.lower() == 'last-modified':
+            result['modified'] = headers[key]
+        elif key.lower() == 'content-encoding':
+            content_encoding = headers[key].lower()
+    result['status'] = getattr(f, 'status', None) or 200
+    baseuri = getattr(f, 'url', '')
+    result['href'] = baseuri
+
+    decompressor = None
+    if content_encoding == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif content_encoding == 'deflate':
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+
+    parser = OPDSParser(baseuri)
+    chunks = []
+    delivered = 0
+    # raised by entries_cb, not a reason to parse again with feedparser
+    callback_error = None
+    read = getattr(f, 'read1', f.read)
+    try:
+        while not _is_cancelled(cancel_token):
+            data = read(CHUNK_SIZE)
+            if not data:
+                break
+            if decompressor is not None:
+                data = decompressor.decompress(data)
+            chunks.append(data)
+            parser.feed_data(data)
+            if parser.finished_entries and not _is_cancelled(cancel_token):
+                entries, parser.finished_entries = \
+                        parser.finished_entries, []
+                delivered += len(entries)
+                try:
+                    entries_cb(parser.feed, entries)
+                except Exception as e:
+                    callback_error = e
+                    break
+        if callback_error is None and not _is_cancelled(cancel_token):
+            parser.close()
+    except Exception as e:
+        if _is_cancelled(cancel_token):
+            f.close()
+            result['feed'], result['entries'] = parser.feed, parser.entries
+            return result
+        logging.debug('Fast parser failed on %s (%s), using feedparser',
+                      uri, e)
+        try:
+            data = f.read()
+            if decompressor is not None:
+                data = decompressor.decompress(data) + decompressor.flush()
+            chunks.append(data)
+        except Exception as read_error:
+            logging.debug('Can not read the rest of %s: %s', uri,
+                          read_error)
+        f.close()
+        # the chunks are already decompressed
+        headers = dict([(k, v) for k, v in headers.items()
+                        if k.lower() != 'content-encoding'])
+        feed, entries, exception = \
+                _parse_with_feedparser(b''.join(chunks), headers)
+        result['feed'], result['entries'] = feed, entries
+        # entries parsed before an error may be only part of the feed
+        if exception is not None:
+            result['bozo'] = 1
+            result['bozo_exception'] = exception
+        if len(entries) > delivered:
+            entries_cb(feed, entries[delivered:])
+        return result
+
+    f.close()
+    if callback_error is not None:
+        raise callback_error
+    result['feed'], result['entries'] = parser.feed, parser.entries
+    return result
@@ -0,0 +1,137 @@
+#! /usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+# partial downloads not resumed for this long are removed
+_MAX_AGE = 30 * 24 * 60 * 60
+
+
+class PartialStore(object):
+    """Keeps the data of interrupted downloads so they can be resumed.
+
+    Every partial download is a .part file with the bytes received so far
+    and a .json file with the validators of the response ('etag',
+    'modified', 'length', 'content_type', and for a download fetched in
+    segments the 'segments' still missing); a partial download is only
+    resumed with a Range request guarded by one of the validators.  The
+    directory is created, and old partial downloads removed, on first use.
+    """
+
+    def __init__(self, path, max_age=_MAX_AGE):
+        self._path = path
+        self._max_age = max_age
+        self._lock = threading.Lock()
+        self._ready = False
+
+    def _get_base_name(self, url):
+        with self._lock:
+            if not self._ready:
+                if not os.path.exists(self._path):
+                    os.makedirs(self._path)
+                self._prune(self._max_age)
+                self._ready = True
+        return os.path.join(self._path,
+                            hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def get_part_path(self, url):
+        return self._get_base_name(url) + '.part'
+
+    def get(self, url):
+        '''
+        Returns (bytes already downloaded, validators) for url, or
+        (0, None) if there is nothing to resume
+        '''
+        base_name = self._get_base_name(url)
+        try:
+            with open(base_name + '.json') as f:
+                validators = json.load(f)
+            size = os.path.getsize(base_name + '.part')
+        except (IOError, OSError, ValueError):
+            return 0, None
+        if validators.get('url') != url:
+            return 0, None
+        # kept as long as it is used
+        os.utime(base_name + '.json', None)
+        return size, validators
+
+    def start(self, url, validators):
+        '''
+        Records the validators of a download starting from the first byte
+        '''
+        base_name = self._get_base_name(url)
+        validators = dict(validators, url=url)
+        try:
+            with open(base_name + '.json.tmp', 'w') as f:
+                json.dump(validators, f)
+            os.rename(base_name + '.json.tmp', base_name + '.json')
+        except (IOError, OSError) as e:
+            logging.warning('Could not save the state of %s: %s', url, e)
+
+    def save_segments(self, url, segments):
+        '''
+        Records the [start, end) ranges still missing from a download
+        fetched in segments, whose part file already has its final size
+        '''
+        base_name = self._get_base_name(url)
+        try:
+            with open(base_name + '.json') as f:
+                validators = json.load(f)
+        except (IOError, OSError, ValueError):
+            # discarded meanwhile
+            return
+        validators['segments'] = segments
+        try:
+            with open(base_name + '.json.tmp', 'w') as f:
+                json.dump(validators, f)
+            os.rename(base_name + '.json.tmp', base_name + '.json')
+        except (IOError, OSError) as e:
+            logging.warning('Could not save the state of %s: %s', url, e)
+
+    def finish(self, url, path):
+        '''
+        Moves the complete download to path
+        '''
+        base_name = self._get_base_name(url)
+        shutil.move(base_name + '.part', path)
+        self._remove(base_name + '.json')
+
+    def discard(self, url):
+        base_name = self._get_base_name(url)
+        self._remove(base_name + '.part')
+        self._remove(base_name + '.json')
+
+    def _prune(self, max_age):
+        limit = time.time() - max_age
+        for name in os.listdir(self._path):
+            file_name = os.path.join(self._path, name)
+            try:
+                if os.path.getmtime(file_name) < limit:
+                    os.remove(file_name)
+            except OSError:
+                pass
+
+    def _remove(self, file_name):
+        try:
+            os.remove(file_name)
+        except OSError:
+            pass
@@ -0,0 +1,66 @@
+#! /usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import collections
+import time
+
+_MAX_QUERIES = 20
+# results older than this are searched again
+_TTL = 10 * 60
+
+
+class QueryCache(object):
+    """Finished opds.QueryResult objects kept in memory.
+
+    The results are keyed by (source, query, language); the least
+    recently used are dropped when there are more than max_queries, and
+    results are not used any more ttl seconds after they were stored.
+    """
+
+    def __init__(self, max_queries=_MAX_QUERIES, ttl=_TTL):
+        self._max_queries = max_queries
+        self._ttl = ttl
+        # key -> (time stored, query result), least recently used first
+        self._results = collections.OrderedDict()
+
+    def get(self, key):
+        '''
+        Returns the query result stored for key, or None
+        '''
+        cached = self._results.get(key)
+        if cached is None:
+            return None
+        stored, query_result = cached
+        if time.time() - stored > self._ttl:
+            del self._results[key]
+            return None
+        self._results.move_to_end(key)
+        return query_result
+
+    def store(self, key, query_result):
+        '''
+        Stores query_result for key, storing it again (when more pages
+        were added) does not make it younger
+        '''
+        cached = self._results.get(key)
+        if cached is None or cached[1] is not query_result:
+            self._results[key] = (time.time(), query_result)
+        self._results.move_to_end(key)
+        while len(self._results) > self._max_queries:
+            self._results.popitem(last=False)
+
+    def clear(self):
+        self._results.clear()
@@ -0,0 +1,135 @@
+#! /usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import bisect
+import re
+import unicodedata
+
+# field weights used to rank the results
+WEIGHT_TITLE = 4
+WEIGHT_AUTHOR = 2
+WEIGHT_PUBLISHER = 1
+
+# a query word matching a whole token counts more than a prefix match
+EXACT_BONUS = 2
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def fold(text):
+    '''
+    Returns text lowercased and without accents
+    '''
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join([c for c in decomposed
+                    if not unicodedata.combining(c)]).casefold()
+
+
+def tokenize(text):
+    '''
+    Returns the folded words of text
+    '''
+    return _TOKEN_RE.findall(fold(text))
+
+
+class SearchIndex(object):
+    """Token index over the books of a catalog.
+
+    Every query word has to match the start of a title, author or
+    publisher word; results are ranked by the weight of the fields that
+    matched.
+    """
+
+    def __init__(self):
+        self._items = []
+        # token -> {item number: weight}
+        self._postings = {}
+        self._tokens = None
+
+    def __len__(self):
+        return len(self._items)
+
+    def add_book(self, book):
+        self.add(book, ((book.get_title(), WEIGHT_TITLE),
+                        (book.get_author(), WEIGHT_AUTHOR),
+                        (book.get_publisher(), WEIGHT_PUBLISHER)))
+
+    def add(self, item, fields):
+        '''
+        Indexes item under the words of fields, a list of (text, weight)
+        '''
+        number = len(self._items)
+        self._items.append(item)
+        for text, weight in fields:
+            if not text or text == 'Unknown':
+                continue
+            for token in tokenize(text):
+                postings = self._postings.setdefault(token, {})
+                postings[number] = postings.get(number, 0) + weight
+        self._tokens = None
+
+    def get_items(self):
+        return self._items
+
+    def get_postings(self):
+        '''
+        Returns [(token, {item number: weight})] sorted by token
+        '''
+        return [(token, self._postings[token])
+                for token in self._get_tokens()]
+
+    def _get_item(self, number):
+        return self._items[number]
+
+    def _get_tokens(self):
+        if self._tokens is None:
+            self._tokens = sorted(self._postings)
+        return self._tokens
+
+    def _lookup(self, word):
+        # {item number: score} of the items with a token starting with word
+        scores = {}
+        tokens = self._get_tokens()
+        position = bisect.bisect_left(tokens, word)
+        while position < len(tokens) and tokens[position].startswith(word):
+            token = tokens[position]
+            bonus = EXACT_BONUS if token == word else 1
+            for number, weight in self._postings[token].items():
+                score = weight * bonus
+                if scores.get(number, 0) < score:
+                    scores[number] = score
+            position += 1
+        return scores
+
+    def search(self, query):
+        '''
+        Returns the items matching all the words of query, best first.
+        An empty query returns all the items in catalog order.
+        '''
+        words = tokenize(query.replace('+', ' '))
+        if not words:
+            return [self._get_item(number) for number in range(len(self))]
+        postings = sorted([self._lookup(word) for word in set(words)],
+                          key=len)
+        scores = postings[0]
+        for other in postings[1:]:
+            if not scores:
+                break
+            scores = dict([(number, score + other[number])
+                           for number, score in scores.items()
+                           if number in other])
+        ranked = sorted(scores, key=lambda number: (-scores[number], number))
+        return [self._get_item(number) for number in ranked]
@@ -0,0 +1,121 @@
+#! /usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Compare opdsparser with feedparser on large OPDS catalogs.
+
+Usage: python tools/bench_opds_parser.py [-n ENTRIES] [-r RUNS] [FILE...]
+
+Without files a synthetic Feedbooks-like catalog is generated.
+"""
+
+import io
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import feedparser
+import opdsparser
+
+_HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom"
+      xmlns:dcterms="http://purl.org/dc/terms/"
+      xmlns:opds="http://opds-spec.org/2010/catalog">
+  <id>http://www.feedbooks.com/books/top.atom</id>
+  <title>Most popular</title>
+  <updated>2012-01-01T00:00:00Z</updated>
+  <link rel="next" type="application/atom+xml"
+        href="http://www.feedbooks.com/books/top.atom?page=2"/>
+'''
+
+_ENTRY = '''  <entry>
+    <title>Book number %(n)d</title>
+    <id>http://www.feedbooks.com/book/%(n)d</id>
+    <author><name>Author %(n)d</name>
+      <uri>http://www.feedbooks.com/author/%(n)d</uri></author>
+    <updated>2012-01-01T00:00:00Z</updated>
+    <dcterms:language>en</dcterms:language>
+    <dcterms:publisher>Feedbooks</dcterms:publisher>
+    <dcterms:issued>1897</dcterms:issued>
+    <category label="Fiction" term="FBFIC000000"/>
+    <summary>A summary for the book number %(n)d, a few sentences long
+      so it has about the size of the summaries Feedbooks sends.</summary>
+    <link rel="http://opds-spec.org/acquisition" type="application/epub+zip"
+          href="http://www.feedbooks.com/book/%(n)d.epub"/>
+    <link rel="http://opds-spec.org/acquisition" type="application/pdf"
+          href="http://www.feedbooks.com/book/%(n)d.pdf"/>
+    <link rel="http://opds-spec.org/image" type="image/jpeg"
+          href="http://covers.feedbooks.net/book/%(n)d.jpg"/>
+    <link rel="http://opds-spec.org/image/thumbnail" type="image/jpeg"
+          href="http://covers.feedbooks.net/book/%(n)d.jpg?size=thumbnail"/>
+    <link rel="alternate" type="text/html"
+          href="http://www.feedbooks.com/book/%(n)d"/>
+  </entry>
+'''
+
+
+def make_catalog(entries):
+    parts = [_HEADER]
+    for n in range(entries):
+        parts.append(_ENTRY % {'n': n})
+    parts.append('</feed>\n')
+    return ''.join(parts).encode('utf-8')
+
+
+def run_feedparser(data):
+    return len(feedparser.parse(io.BytesIO(data))['entries'])
+
+
+def run_opdsparser(data):
+    return len(opdsparser.parse(data)[1])
+
+
+def bench(name, function, data, runs):
+    best = None
+    for i in range(runs):
+        start = time.time()
+        entries = function(data)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    print('%-12s %6d entries  %8.1f ms  %8.3f ms/entry' % (name, entries,
+            best * 1000, best * 1000 / max(entries, 1)))
+    return best
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [-n ENTRIES] [FILE...]')
+    parser.add_option('-n', '--entries', type='int', default=500,
+                      help='entries in the generated catalog')
+    parser.add_option('-r', '--runs', type='int', default=3,
+                      help='runs per parser, the best one is reported')
+    options, files = parser.parse_args()
+
+    if files:
+        documents = [(path, open(path, 'rb').read()) for path in files]
+    else:
+        documents = [('generated', make_catalog(options.entries))]
+
+    for name, data in documents:
+        print('%s (%d KB)' % (name, len(data) / 1024))
+        slow = bench('feedparser', run_feedparser, data, options.runs)
+        fast = bench('opdsparser', run_opdsparser, data, options.runs)
+        print('speedup      %.1fx' % (slow / fast))
+
+
+if __name__ == '__main__':
+    main()
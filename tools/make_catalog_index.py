@@ -0,0 +1,70 @@
+#! /usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Write the catalog.idx of volumes prepared for sneakernet.
+
+Usage: python tools/make_catalog_index.py [-f] PATH...
+
+PATH is a catalog.xml or the directory holding it; the index is written
+next to the catalog, so the activity does not have to build it when the
+volume is mounted.
+"""
+
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import catalogindex
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [-f] PATH...')
+    parser.add_option('-f', '--force', action='store_true', default=False,
+                      help='build the index even if it is up to date')
+    options, paths = parser.parse_args()
+    if not paths:
+        parser.error('no catalog given')
+
+    failed = False
+    for path in paths:
+        if os.path.isdir(path):
+            path = os.path.join(path, 'catalog.xml')
+        index_path = catalogindex.get_index_path(path)
+        try:
+            stat = os.stat(path)
+            index = catalogindex.open_index(index_path)
+            if not options.force and index is not None and \
+                    index.is_current(stat):
+                print('%s is up to date' % index_path)
+                continue
+            start = time.time()
+            data = catalogindex.build_from_catalog(path)
+            catalogindex.write(index_path, data)
+        except Exception as e:
+            print('%s: %s' % (path, e), file=sys.stderr)
+            failed = True
+            continue
+        index = catalogindex.CatalogIndex(data)
+        print('%s: %d books, %d KB in %.1f s' % (index_path, len(index),
+                len(data) / 1024, time.time() - start))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
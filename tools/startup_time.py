@@ -0,0 +1,176 @@
+#! /usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+"""Measure how long the activity takes to start.
+
+Usage: python tools/startup_time.py [-m MODULE]... [-n TOP] [-b MS]
+       python tools/startup_time.py --paint [-c COMMAND] [-t SECONDS] [-b MS]
+
+The first form imports the modules (opds by default) in a new
+interpreter with -X importtime, prints the slowest imports and fails if
+one of the modules that are meant to be loaded on first use was
+imported, or if the imports took more than -b milliseconds.
+
+The second form starts the activity, inside a Sugar session, and prints
+the time from the import of GetIABooksActivity to the end of the
+construction of the activity and to the first paint of its window, as
+logged by the activity.  It fails if the first paint took more than -b
+milliseconds.
+"""
+
+import optparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# imported on the first download or search, never at startup
+_LAZY_MODULES = ('feedparser', 'sgmllib', 'asyncio', 'csv', 'http.client',
+                 'urllib.request', 'xml.etree.ElementTree', 'catalogindex',
+                 'httppool', 'netengine')
+
+_IMPORT_LINE = re.compile(r'^import time:\s*(\d+) \|\s*(\d+) \| (\s*)(\S+)')
+_BUILD_LINE = re.compile(r'Activity built (\d+) ms')
+_PAINT_LINE = re.compile(r'First paint (\d+) ms')
+
+
+def _get_exec():
+    with open(os.path.join(_ROOT, 'activity', 'activity.info')) as f:
+        for line in f:
+            key, _, value = line.partition('=')
+            if key.strip() == 'exec':
+                return value.strip()
+    return 'sugar-activity3 GetIABooksActivity.GetIABooksActivity'
+
+
+def measure_imports(modules):
+    '''
+    Returns (total us, [(self us, cumulative us, name)]) of importing
+    modules in a new interpreter
+    '''
+    code = ''.join(['import %s\n' % module for module in modules])
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                             cwd=_ROOT, stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE, universal_newlines=True)
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr.strip().splitlines()[-1])
+    total = 0
+    imports = []
+    for line in process.stderr.splitlines():
+        match = _IMPORT_LINE.match(line)
+        if match is None:
+            continue
+        self_time, cumulative, indent, name = match.groups()
+        imports.append((int(self_time), int(cumulative), name))
+        if not indent:
+            total += int(cumulative)
+    return total, imports
+
+
+def measure_paint(command, timeout):
+    '''
+    Returns (ms to the end of the construction, ms to the first paint)
+    logged by the activity started with command, None for what was not
+    logged in timeout seconds
+    '''
+    env = dict(os.environ, SUGAR_BUNDLE_PATH=_ROOT, SUGAR_LOGGER_LEVEL='debug')
+    process = subprocess.Popen(command, shell=True, cwd=_ROOT, env=env,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT,
+                               universal_newlines=True)
+    limit = time.time() + timeout
+    built = None
+    try:
+        for line in process.stdout:
+            match = _BUILD_LINE.search(line)
+            if match is not None:
+                built = int(match.group(1))
+            match = _PAINT_LINE.search(line)
+            if match is not None:
+                return built, int(match.group(1))
+            if time.time() > limit:
+                break
+        return built, None
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = optparse.OptionParser(
+            usage='%prog [-m MODULE]... [-n TOP] [-b MS] | --paint')
+    parser.add_option('-m', '--module', action='append', dest='modules',
+                      help='module to import, opds by default')
+    parser.add_option('-n', '--top', type='int', default=15,
+                      help='slowest imports shown')
+    parser.add_option('-b', '--budget', type='float', default=None,
+                      help='fail if the imports, or the first paint, '
+                           'take more ms')
+    parser.add_option('-p', '--paint', action='store_true', default=False,
+                      help='time the first paint of the activity')
+    parser.add_option('-c', '--command', default=None,
+                      help='command starting the activity')
+    parser.add_option('-t', '--timeout', type='float', default=60,
+                      help='seconds to wait for the first paint')
+    options, args = parser.parse_args()
+    if args:
+        parser.error('unexpected arguments')
+
+    if options.paint:
+        built, paint = measure_paint(options.command or _get_exec(),
+                                     options.timeout)
+        if built is not None:
+            print('activity     %6d ms' % built)
+        if paint is None:
+            print('The first paint was not logged', file=sys.stderr)
+            sys.exit(1)
+        print('first paint  %6d ms' % paint)
+        if options.budget is not None and paint > options.budget:
+            print('over the budget of %.1f ms' % options.budget,
+                  file=sys.stderr)
+            sys.exit(1)
+        return
+
+    try:
+        total, imports = measure_imports(options.modules or ['opds'])
+    except RuntimeError as e:
+        print('Can not import: %s' % e, file=sys.stderr)
+        sys.exit(1)
+    print('imports      %8.1f ms' % (total / 1000.0))
+    for self_time, cumulative, name in sorted(imports, reverse=True,
+            key=lambda item: item[0])[:options.top]:
+        print('  %-32s %8.1f ms  %8.1f ms cumulative' % (name,
+              self_time / 1000.0, cumulative / 1000.0))
+
+    failed = False
+    names = set([name for _, _, name in imports])
+    for name in _LAZY_MODULES:
+        if name in names:
+            print('%s is imported at startup' % name, file=sys.stderr)
+            failed = True
+    if options.budget is not None and total / 1000.0 > options.budget:
+        print('over the budget of %.1f ms' % options.budget, file=sys.stderr)
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+#! /usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import logging
+import queue
+import threading
+
+QUEUE_FEEDS = 'feeds'
+QUEUE_COVERS = 'covers'
+QUEUE_BOOKS = 'books'
+# speculative downloads, kept on their own queue so they never delay
+# what the user asked for
+QUEUE_PREFETCH = 'prefetch'
+
+DEFAULT_WORKERS = {QUEUE_FEEDS: 2, QUEUE_COVERS: 2, QUEUE_BOOKS: 2,
+                   QUEUE_PREFETCH: 1}
+
+
+class CancelToken(object):
+    """Cancellation flag shared by the steps of a download.
+
+    Resources registered with the token (responses, sockets, files) are
+    aborted as soon as the token is cancelled, which makes a blocked read
+    in another thread return right away.
+    """
+
+    def __init__(self):
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._resources = []
+
+    def cancel(self):
+        with self._lock:
+            if self._cancelled.is_set():
+                return
+            self._cancelled.set()
+            resources, self._resources = self._resources, []
+        for resource in resources:
+            _abort(resource)
+
+    def is_cancelled(self):
+        return self._cancelled.is_set()
+
+    def wait(self, timeout):
+        '''
+        Sleeps for timeout seconds, returns True at once if the token is
+        cancelled meanwhile
+        '''
+        return self._cancelled.wait(timeout)
+
+    def register(self, resource):
+        with self._lock:
+            if not self._cancelled.is_set():
+                self._resources.append(resource)
+                return
+        _abort(resource)
+
+    def unregister(self, resource):
+        with self._lock:
+            if resource in self._resources:
+                self._resources.remove(resource)
+
+
+def _abort(resource):
+    try:
+        if hasattr(resource, 'abort'):
+            resource.abort()
+        else:
+            resource.close()
+    except Exception as e:
+        logging.debug('Error aborting %s: %s', resource, e)
+
+
+class Task(object):
+    """A unit of work run by a WorkerPool.
+
+    Subclasses implement run(); stop() cancels the task token, tasks
+    stopped before they start are never run.
+    """
+
+    def __init__(self):
+        self.token = CancelToken()
+
+    def run(self):
+        raise NotImplementedError
+
+    def stop(self):
+        self.token.cancel()
+
+    def is_stopped(self):
+        return self.token.is_cancelled()
+
+
+class _WorkerQueue(object):
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.active = 0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def put(self, task):
+        self._queue.put(task)
+        with self._lock:
+            if len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work,
+                        name='%s-%d' % (self.name, len(self._threads)))
+                thread.daemon = True
+                self._threads.append(thread)
+                thread.start()
+
+    def get_queued(self):
+        return self._queue.qsize()
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                break
+            if task.is_stopped():
+                continue
+            with self._lock:
+                self.active += 1
+            try:
+                task.run()
+            except Exception:
+                logging.exception('Task %s failed in queue %s',
+                                  task, self.name)
+            finally:
+                with self._lock:
+                    self.active -= 1
+
+    def shutdown(self):
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            self._queue.put(None)
+
+
+class WorkerPool(object):
+    """Fixed number of worker threads per named queue.
+
+    Threads are only started when work is queued, so an idle queue costs
+    nothing.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS):
+        self._queues = {}
+        for name in workers:
+            self._queues[name] = _WorkerQueue(name, workers[name])
+
+    def submit(self, queue_name, task):
+        '''
+        Queues a Task, returns the task
+        '''
+        self._queues[queue_name].put(task)
+        return task
+
+    def get_stats(self):
+        '''
+        Returns {queue name: {'workers', 'active', 'queued'}} counters
+        '''
+        stats = {}
+        for name, worker_queue in self._queues.items():
+            stats[name] = {'workers': worker_queue.workers,
+                           'active': worker_queue.active,
+                           'queued': worker_queue.get_queued()}
+        return stats
+
+    def shutdown(self):
+        '''
+        Lets the workers exit once the queued tasks are done
+        '''
+        for worker_queue in self._queues.values():
+            worker_queue.shutdown()